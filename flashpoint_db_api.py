@@ -2,7 +2,16 @@
 
 import sys
 import os
+import json
+import mmap
+import time
 import random
+import struct
+import shutil
+import threading
+import traceback
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 import httputil
 
 def _game_id_to_path(game_id: str):
@@ -10,37 +19,155 @@ def _game_id_to_path(game_id: str):
         raise ValueError('invalid game_id ' + game_id)
     return game_id[:2] + '/' + game_id[2:4] + '/' + game_id
 
+class GameIndex:
+    """Memory-mapped file with one json record per game, games are only decoded when sampled."""
+
+    # magic, version, game count, creation time
+    _HEADER = struct.Struct('<4sIQd')
+    _MAGIC = b'FPIX'
+    _VERSION = 1
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, self.created = self._HEADER.unpack_from(self._data, 0)
+        if magic != self._MAGIC or version != self._VERSION:
+            raise ValueError('unsupported game index format')
+        offsets_size = (self.count + 1) * 8
+        if len(self._data) < self._HEADER.size + offsets_size:
+            raise ValueError('truncated game index')
+        self._offsets = memoryview(self._data)[self._HEADER.size:self._HEADER.size + offsets_size].cast('Q')
+        self._records_start = self._HEADER.size + offsets_size
+        if len(self._data) < self._records_start + self._offsets[-1]:
+            raise ValueError('truncated game index')
+
+    def __len__(self):
+        return self.count
+
+    def get_game(self, i: int) -> dict:
+        """decode the game with the given index"""
+        start = self._records_start + self._offsets[i]
+        end = self._records_start + self._offsets[i + 1]
+        game_id, title, platform = json.loads(self._data[start:end])
+        return {'id': game_id, 'title': title, 'platform': platform}
+
+    @classmethod
+    def write(cls, path: str, games):
+        """write the games from an iterable into a new index file, without keeping them in memory"""
+        offsets = array('Q', [0])
+        records_path = f'{path}.{os.getpid()}.records'
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(records_path, 'wb') as records:
+                for game in games:
+                    record = json.dumps([game['id'], game['title'], game['platform']]).encode()
+                    records.write(record)
+                    offsets.append(offsets[-1] + len(record))
+            with open(tmp_path, 'wb') as f:
+                f.write(cls._HEADER.pack(cls._MAGIC, cls._VERSION, len(offsets) - 1, time.time()))
+                f.write(offsets.tobytes())
+                with open(records_path, 'rb') as records:
+                    shutil.copyfileobj(records, f)
+            os.replace(tmp_path, path)
+        finally:
+            # don't leave partial files behind when fetching the games failed
+            for leftover in (records_path, tmp_path):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+
 class FlashpointDbApi:
     """Client for querying the flashpoint DB API for random games, caches the results locally."""
 
     _BASE_URL = 'https://db-api.unstable.life/'
     _DB_URL = 'https://flashpointproject.github.io/flashpoint-database/search/#'
     _ASSET_URL = 'https://infinity.unstable.life/'
+    _PAGE_SIZE = 1000
+    # wait this many seconds after starting a refresh before starting another one, e.g. after it failed
+    _REFRESH_RETRY_INTERVAL = 600
 
-    def __init__(self, name: str, query_filter: str, cache_dir: str):
+    def __init__(self, name: str, query_filter: str, cache_dir: str, max_age=7*24*3600,
+                 description=None, eager=False):
         self.name = name
         self.query_filter = query_filter
+        self.description = description or name
+        # eager collections are loaded at startup, the others on their first pull
+        self.eager = eager
         self.cache_dir = cache_dir
+        # the index is refreshed in the background when it is older than this
+        self.max_age = max_age
         self.db = None
+        self._refresh_lock = threading.Lock()
+        self._last_refresh = float('-inf')
+
+    def _index_path(self):
+        return os.path.join(self.cache_dir, self.name + '.idx')
+
+    def _build_index(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        GameIndex.write(self._index_path(), self.iter_games())
+        return GameIndex(self._index_path())
+
+    def _refresh_db(self):
+        try:
+            self.db = self._build_index()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self._refresh_lock.release()
 
     def _load_db(self):
-        self.db = self.get_games()
+        with self._refresh_lock:
+            if self.db:
+                return # loaded by a concurrent call
+            try:
+                self.db = GameIndex(self._index_path())
+            except (OSError, ValueError, struct.error):
+                # missing, outdated or corrupt index
+                self.db = self._build_index()
+
+    def load(self):
+        """make sure the game index is loaded, building it first if there is none on disk"""
+        if not self.db:
+            self._load_db()
+
+    def after_fork(self):
+        """reset the refresh state after forking, the refresh thread doesn't exist in the child"""
+        self._refresh_lock = threading.Lock()
 
     def _request(self, url: str, cache_path=None):
         full_url = self._BASE_URL + url
         full_cache_path = os.path.join(self.cache_dir, cache_path) if cache_path else None
         return httputil.cached_request(full_url, full_cache_path)
 
+    def iter_games(self):
+        """get the filtered games page by page, so that large results don't have to fit in memory"""
+        offset = 0
+        while True:
+            url = (f'search?filter=true&fields=id,title,platform&limit={self._PAGE_SIZE}&offset={offset}&'
+                   + self.query_filter)
+            page = self._request(url)
+            yield from page
+            if len(page) < self._PAGE_SIZE:
+                break
+            offset += len(page)
+
     def get_games(self):
         """get the list of filtered games"""
-        url = 'search?filter=true&fields=id,title,platform&' + self.query_filter
-        return self._request(url, cache_path=self.name + '.json')
+        return list(self.iter_games())
 
-    def get_random_game(self) -> list:
-        """return a random game from the cached game list"""
-        if not self.db:
-            self._load_db()
-        return random.choice(self.db)
+    def get_random_game(self) -> dict:
+        """return a random game from the cached game index"""
+        self.load()
+        db = self.db
+        if (time.time() - db.created > self.max_age
+                and time.monotonic() - self._last_refresh >= self._REFRESH_RETRY_INTERVAL
+                and self._refresh_lock.acquire(blocking=False)):
+            self._last_refresh = time.monotonic()
+            threading.Thread(target=self._refresh_db, daemon=True).start()
+        if not len(db):
+            raise Exception('game list is empty')
+        return db.get_game(random.randrange(len(db)))
 
     def make_db_url(self, game_id: str) -> str:
         """return the url of the game with the given id"""
@@ -56,18 +183,53 @@ class FlashpointDbApi:
         game_path = _game_id_to_path(game_id)
         return self._ASSET_URL + f'images/Screenshots/{game_path}.png'
 
-def get_api(name, query_filter):
+# used if there is no flashpoint_config.json
+_DEFAULT_COLLECTIONS = [
+    {'name': 'games2jolly', 'filter': 'developer=games2jolly', 'description': 'Games2Jolly', 'eager': True}
+]
+
+def get_api(name, query_filter, max_age=7*24*3600, description=None, eager=False):
     """Create a new FlashpointDbApi instance."""
-    return FlashpointDbApi(name, query_filter, 'flashpointdb')
+    return FlashpointDbApi(name, query_filter, 'flashpointdb', max_age=max_age,
+                           description=description, eager=eager)
+
+def get_collections() -> dict:
+    """Create the FlashpointDbApi instances for the collections in flashpoint_config.json, by name."""
+    try:
+        with open('flashpoint_config.json', 'rb') as f:
+            configs = json.load(f)['collections']
+    except FileNotFoundError:
+        configs = _DEFAULT_COLLECTIONS
+    return {cfg['name']: get_api(cfg['name'], cfg['filter'],
+                                 max_age=cfg.get('max_age', 7*24*3600),
+                                 description=cfg.get('description'),
+                                 eager=cfg.get('eager', False))
+            for cfg in configs}
+
+def load_collections(collections: dict, workers=4):
+    """Load the indexes of all eager collections in parallel, a failed collection is retried on its first pull."""
+    eager = [api for api in collections.values() if api.eager]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for api, future in [(api, pool.submit(api.load)) for api in eager]:
+            try:
+                future.result()
+            except Exception:
+                print('failed to load flashpoint collection', api.name)
+                traceback.print_exc()
 
 def main():
     """main entry point if script is called directly."""
     cmd = sys.argv[1] if len(sys.argv) > 1 else None
     instance_name = sys.argv[2] if len(sys.argv) > 2 else None
     query_filter = sys.argv[3] if len(sys.argv) > 3 else None
-    api = get_api(instance_name, query_filter)
     if cmd == 'random':
+        api = get_api(instance_name, query_filter)
         print(api.get_random_game())
+    elif cmd == 'collections':
+        collections = get_collections()
+        load_collections(collections)
+        for api in collections.values():
+            print(api.name, api.description, len(api.db) if api.db else 'not loaded')
 
 if __name__ == '__main__':
     main()
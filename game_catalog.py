@@ -0,0 +1,188 @@
+"""Compact binary snapshot of the game lists, can be memory-mapped instead of parsing the json files."""
+
+import os
+import mmap
+import struct
+from array import array
+from collections.abc import Sequence
+
+_MAGIC = b'TTGC'
+_VERSION = 1
+# magic, version, game count, string count, bucket count, timestamp, filter checksum.
+# the columns that follow use native byte order.
+_HEADER = struct.Struct('<4sIIIIdI')
+# console id, nonempty, hack, start, end
+_BUCKET_FIELDS = 5
+# int columns per game: ID, ConsoleID, NumAchievements, title, icon and console name string index
+_GAME_COLUMNS = ['ids', 'console_ids', 'num_achievements', 'titles', 'icons', 'console_names']
+
+
+def _align(n: int) -> int:
+    return (n + 7) & ~7
+
+
+class Game:
+    """A game from the catalog, with only the fields that are actually used."""
+
+    __slots__ = ('id', 'title', 'console_id', 'console_name', 'image_icon', 'num_achievements')
+
+    def __init__(self, game_id: int, title: str, console_id: int, console_name: str,
+                 image_icon: str, num_achievements: int):
+        self.id = game_id
+        self.title = title
+        self.console_id = console_id
+        self.console_name = console_name
+        self.image_icon = image_icon
+        self.num_achievements = num_achievements
+
+    def __repr__(self):
+        return f'Game({self.id}, {self.title!r}, {self.console_name!r}, {self.num_achievements} achievements)'
+
+
+class GameList(Sequence):
+    """Read-only view of a range of games in the catalog, the game objects are created on access."""
+
+    def __init__(self, catalog, start: int, end: int):
+        self.catalog = catalog
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('game index out of range')
+        return self.catalog.get_game(self.start + i)
+
+
+def merge_adjacent(lists: list) -> list:
+    """merge views of neighbouring ranges of the same catalog, so there are fewer lists to sample from"""
+    merged = []
+    for games in sorted(lists, key=lambda g: g.start):
+        last = merged[-1] if merged else None
+        if last and last.catalog is games.catalog and last.end == games.start:
+            merged[-1] = GameList(games.catalog, last.start, games.end)
+        else:
+            merged.append(games)
+    return merged
+
+
+class GameCatalog:
+    """Columnar game data with a shared string table, sorted so that all games with the same
+       (nonempty, hack, ConsoleID) are stored next to each other."""
+
+    def __init__(self, data):
+        # bytes or a memory-mapped file
+        self._data = data
+        magic, version, game_count, string_count, bucket_count, timestamp, filter_crc = \
+            _HEADER.unpack_from(data, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError('unsupported game catalog format')
+        self.game_count = game_count
+        self.timestamp = timestamp
+        self.filter_crc = filter_crc
+        view = memoryview(data)
+        pos = _align(_HEADER.size)
+        def column(typecode, count):
+            nonlocal pos
+            size = count * struct.calcsize(typecode)
+            if pos + size > len(view):
+                raise ValueError('truncated game catalog')
+            col = view[pos:pos + size].cast(typecode)
+            pos = _align(pos + size)
+            return col
+        bucket_table = column('i', bucket_count * _BUCKET_FIELDS)
+        for name in _GAME_COLUMNS:
+            setattr(self, name, column('i', game_count))
+        self._string_offsets = column('I', string_count + 1)
+        if pos + self._string_offsets[-1] > len(view):
+            raise ValueError('truncated game catalog')
+        self._strings = view[pos:pos + self._string_offsets[-1]]
+        # (nonempty, hack, console id) -> list view
+        self.buckets = {}
+        for b in range(bucket_count):
+            console_id, nonempty, hack, start, end = bucket_table[b * _BUCKET_FIELDS:(b + 1) * _BUCKET_FIELDS]
+            self.buckets[(bool(nonempty), bool(hack), console_id)] = GameList(self, start, end)
+        nonempty_starts = [v.start for (nonempty, _, _), v in self.buckets.items() if nonempty]
+        self.nonempty_start = min(nonempty_starts) if nonempty_starts else game_count
+
+    def get_string(self, i: int) -> str:
+        """return the string with the given index from the string table"""
+        return str(self._strings[self._string_offsets[i]:self._string_offsets[i + 1]], 'utf-8')
+
+    def get_game(self, i: int) -> Game:
+        """return the game at the given position in the catalog"""
+        return Game(self.ids[i], self.get_string(self.titles[i]),
+                    self.console_ids[i], self.get_string(self.console_names[i]),
+                    self.get_string(self.icons[i]), self.num_achievements[i])
+
+    def all_games(self) -> GameList:
+        """return all games in the catalog"""
+        return GameList(self, 0, self.game_count)
+
+    def nonempty_games(self) -> GameList:
+        """return all games with achievements"""
+        return GameList(self, self.nonempty_start, self.game_count)
+
+
+def encode_catalog(games: list, hack_str: str, timestamp: float, filter_crc: int) -> bytes:
+    """serialize the game dicts from the RA API into the binary catalog format"""
+    def sort_key(g):
+        return (bool(g['NumAchievements']), hack_str in g['Title'], int(g['ConsoleID']))
+    games = sorted(games, key=sort_key)
+    strings = {}
+    def string_index(s):
+        return strings.setdefault(s, len(strings))
+    columns = {name: array('i') for name in _GAME_COLUMNS}
+    bucket_table = array('i')
+    last_key = None
+    for i, g in enumerate(games):
+        key = sort_key(g)
+        if key != last_key:
+            if last_key is not None:
+                bucket_table[-1] = i
+            bucket_table.extend([key[2], int(key[0]), int(key[1]), i, len(games)])
+            last_key = key
+        columns['ids'].append(int(g['ID']))
+        columns['console_ids'].append(int(g['ConsoleID']))
+        columns['num_achievements'].append(int(g['NumAchievements'] or 0))
+        columns['titles'].append(string_index(g['Title']))
+        columns['icons'].append(string_index(g['ImageIcon']))
+        columns['console_names'].append(string_index(g['ConsoleName']))
+    encoded = [s.encode('utf-8') for s in strings]
+    string_offsets = array('I', [0])
+    for s in encoded:
+        string_offsets.append(string_offsets[-1] + len(s))
+
+    out = bytearray(_HEADER.pack(_MAGIC, _VERSION, len(games), len(strings),
+                                 len(bucket_table) // _BUCKET_FIELDS, timestamp, filter_crc))
+    for section in [bucket_table] + [columns[name] for name in _GAME_COLUMNS] + [string_offsets]:
+        out += b'\0' * (_align(len(out)) - len(out))
+        out += section.tobytes()
+    out += b'\0' * (_align(len(out)) - len(out))
+    out += b''.join(encoded)
+    return bytes(out)
+
+
+def write_catalog(path: str, data: bytes):
+    """atomically write an encoded catalog file"""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def load_catalog(path: str):
+    """memory-map a catalog file, so that all processes share the same pages,
+       returns None if the file is missing or can't be used"""
+    try:
+        with open(path, 'rb') as f:
+            mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return GameCatalog(mapped_file)
+    except (OSError, ValueError, struct.error, TypeError):
+        return None
@@ -1,32 +1,484 @@
-import urllib.request
 import urllib.error
+import urllib.parse
+import http.client
+from concurrent.futures import Future
+import io
 import os
+import gzip
 import json
+import time
+import threading
+from collections import OrderedDict
+import metrics
 
-def _cached_request_impl(url: str, cache_path=None):
+class HttpResponse:
+    """Status, headers and (decompressed) body of a finished request."""
+
+    def __init__(self, status: int, headers, body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+class HttpClient:
+    """HTTP client that keeps connections open for reuse, with one pool per host."""
+
+    _MAX_REDIRECTS = 5
+
+    def __init__(self, timeout=10.0, max_idle_per_host=8):
+        self.timeout = timeout
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = {}
+        self._lock = threading.Lock()
+        # per host: requests, errors, rate-limited requests, bytes received and total seconds
+        self.metrics = {}
+
+    def _get_connection(self, scheme: str, host: str):
+        with self._lock:
+            idle = self._idle.get((scheme, host))
+            if idle:
+                return idle.pop(), True
+        cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return cls(host, timeout=self.timeout), False
+
+    def _release_connection(self, scheme: str, host: str, conn):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, host), [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _record(self, host: str, start: float, size: int, failed: bool, rate_limited=False):
+        with self._lock:
+            m = self.metrics.setdefault(host, {'requests': 0, 'errors': 0, 'rate_limited': 0,
+                                               'bytes': 0, 'seconds': 0.0})
+            m['requests'] += 1
+            m['errors'] += int(failed)
+            m['rate_limited'] += int(rate_limited)
+            m['bytes'] += size
+            m['seconds'] += time.monotonic() - start
+
+    def _send(self, method: str, scheme: str, host: str, path: str, body, headers: dict):
+        for attempt in range(2):
+            conn, reused = self._get_connection(scheme, host)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                # the server may have closed an idle connection, try once more with a fresh one
+                if reused and attempt == 0:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._release_connection(scheme, host, conn)
+            return resp, data
+
+    def request(self, url: str, method='GET', body=None, headers=None) -> HttpResponse:
+        """Make an http request, raises urllib.error.HTTPError for error (and not modified) responses."""
+        all_headers = {'User-Agent': 'TrophyTroopa', 'Accept-Encoding': 'gzip'}
+        if headers:
+            all_headers.update(headers)
+        for _ in range(self._MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            start = time.monotonic()
+            try:
+                resp, data = self._send(method, parts.scheme, parts.netloc, path, body, all_headers)
+            except Exception:
+                self._record(parts.netloc, start, 0, True)
+                raise
+            self._record(parts.netloc, start, len(data), resp.status >= 400, resp.status == 429)
+            if resp.status in (301, 302, 303, 307, 308) and resp.headers.get('Location'):
+                url = urllib.parse.urljoin(url, resp.headers['Location'])
+                if resp.status == 303:
+                    method, body = 'GET', None
+                continue
+            if resp.headers.get('Content-Encoding') == 'gzip':
+                data = gzip.decompress(data)
+            if resp.status >= 300:
+                raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, io.BytesIO(data))
+            return HttpResponse(resp.status, resp.headers, data)
+        raise urllib.error.HTTPError(url, resp.status, 'too many redirects', resp.headers, io.BytesIO(data))
+
+
+# shared by all api clients, so that connections are reused between them
+client = HttpClient(timeout=float(os.environ.get('HTTP_TIMEOUT', 10)))
+
+def _reset_after_fork():
+    # connections can't be shared between processes, the child starts with an empty pool
+    client._idle = {}
+    client._lock = threading.Lock()
+    _REQUESTS_IN_FLIGHT.after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _read_meta(cache_path: str) -> dict:
+    try:
+        with open(cache_path + '.meta', 'rb') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_file(path: str, data: bytes):
+    # write to a temporary file first, so that hard-linked files are replaced instead of modified
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def _cached_request_impl(url: str, cache_path=None, revalidate=False):
     json_resp = None
-    if not cache_path or not os.path.exists(cache_path):
-        req = urllib.request.Request(url)
-        req.add_header("User-Agent", "TrophyTroopa")
-        with urllib.request.urlopen(req) as resp:
-            json_resp = resp.read()
-            if cache_path:
-                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
-                with open(cache_path, 'wb') as f:
-                    f.write(json_resp)
+    has_cache = bool(cache_path) and os.path.exists(cache_path)
+    result = 'hit'
+    if not has_cache or revalidate:
+        result = 'miss'
+        headers = {}
+        meta = _read_meta(cache_path) if has_cache else {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            resp = client.request(url, headers=headers)
+            json_resp = resp.body
+            new_meta = {'etag': resp.headers.get('ETag'),
+                        'last_modified': resp.headers.get('Last-Modified')}
+        except urllib.error.HTTPError as ex:
+            if ex.code != 304 or not has_cache:
+                raise
+            # not modified, keep using the cached file
+            result = 'not_modified'
+        if json_resp and cache_path:
+            # only rewrite the cache if the content changed
+            if not has_cache or _read_file(cache_path) != json_resp:
+                _write_file(cache_path, json_resp)
+            if new_meta != meta and any(new_meta.values()):
+                _write_file(cache_path + '.meta', json.dumps(new_meta).encode())
 
     if not json_resp:
-        with open(cache_path, 'rb') as f:
-            json_resp = f.read()
+        json_resp = _read_file(cache_path)
 
+    metrics.count('cached_request_total', result=result)
     return json.loads(json_resp)
 
-def cached_request(url: str, cache_path=None, ignore_error=False):
-    """Make an http request and cache the json result."""
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+class SingleFlight:
+    """Lets concurrent callers with the same key share the result of a single call."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def after_fork(self):
+        """forget the calls of the parent process, their threads don't exist in the child"""
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """call func(), or wait for the result of the call that is already running for the key"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+        if not leader:
+            return call.result()
+        try:
+            result = func()
+            call.set_result(result)
+            return result
+        except BaseException as ex:
+            call.set_exception(ex)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+_REQUESTS_IN_FLIGHT = SingleFlight()
+
+@metrics.timed('cached_request_seconds')
+def cached_request(url: str, cache_path=None, ignore_error=False, revalidate=False):
+    """Make an http request and cache the json result.
+       With revalidate=True, an existing cache file is checked with a conditional request.
+       Concurrent calls for the same url and cache file share one request."""
     try:
-        return _cached_request_impl(url, cache_path)
+        return _REQUESTS_IN_FLIGHT.do((url, cache_path, revalidate),
+                                      lambda: _cached_request_impl(url, cache_path, revalidate))
     except urllib.error.HTTPError:
         if ignore_error:
             return None
         else:
             raise
+
+
+class TtlCache:
+    """Bounded in-memory LRU cache for json results that expire after a while,
+       optionally backed by one file per key on disk."""
+
+    def __init__(self, max_entries=1024, ttl=24*3600, stale_ttl=0, cache_dir=None, name='ttl_cache'):
+        # reported as label of the cache metrics
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # expired entries younger than ttl + stale_ttl are still returned, but refreshed in the background
+        self.stale_ttl = stale_ttl
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._fetches_in_flight = SingleFlight()
+
+    def after_fork(self):
+        """reset the locks and the refresh state after os.fork(), the cached entries stay valid"""
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._fetches_in_flight.after_fork()
+
+    def _disk_path(self, key: str):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def _load_from_disk(self, key: str):
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            timestamp = os.stat(path).st_mtime
+            with open(path, 'rb') as f:
+                return timestamp, json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def _insert(self, key: str, entry: tuple):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _store(self, key: str, value, timestamp: float):
+        self._insert(key, (timestamp, value))
+        if self.cache_dir:
+            _write_file(self._disk_path(key), json.dumps(value).encode())
+
+    def _fetch(self, key: str, fetch):
+        value = self._fetches_in_flight.do(key, fetch)
+        # don't remember failures, e.g. None for ignored http errors
+        if value is not None:
+            self._store(key, value, time.time())
+        return value
+
+    def _refresh(self, key: str, fetch):
+        try:
+            self._fetch(key, fetch)
+        except Exception:
+            pass # keep serving the stale value
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def peek(self, key: str):
+        """return the cached value for the key regardless of its age, or None without fetching it"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if not entry:
+            entry = self._load_from_disk(key)
+        return entry[1] if entry else None
+
+    def get(self, key: str, fetch):
+        """return the cached value for the key, or call fetch() to get and cache a new one"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+        if not entry:
+            entry = self._load_from_disk(key)
+            if entry:
+                self._insert(key, entry)
+        if not entry:
+            metrics.count('cache_total', cache=self.name, result='miss')
+            return self._fetch(key, fetch)
+        timestamp, value = entry
+        age = time.time() - timestamp
+        if age < self.ttl:
+            metrics.count('cache_total', cache=self.name, result='hit')
+            return value
+        if age >= self.ttl + self.stale_ttl:
+            metrics.count('cache_total', cache=self.name, result='expired')
+            return self._fetch(key, fetch)
+        metrics.count('cache_total', cache=self.name, result='stale')
+        with self._lock:
+            start_refresh = key not in self._refreshing
+            self._refreshing.add(key)
+        if start_refresh:
+            threading.Thread(target=self._refresh, args=(key, fetch), daemon=True).start()
+        return value
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream while its circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Stops calling an upstream after repeated failures or slow responses, so that callers can fall back
+       right away instead of waiting on it. After reset_timeout a single probe call is let through,
+       and the breaker closes again if it succeeds."""
+
+    def __init__(self, name: str, failure_threshold=5, reset_timeout=30.0, latency_budget=None):
+        # reported as label of the breaker metrics
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        # calls that take longer than this many seconds count as failures, even if they succeed
+        self.latency_budget = latency_budget
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def after_fork(self):
+        """reset the lock after os.fork(), a probe of the parent process never finishes in the child"""
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def is_open(self) -> bool:
+        """return True while calls are rejected, i.e. until it's time for the next probe"""
+        with self._lock:
+            return self._opened_at is not None and \
+                (self._probing or time.monotonic() < self._opened_at + self.reset_timeout)
+
+    def _allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing or time.monotonic() < self._opened_at + self.reset_timeout:
+                return False
+            # half-open, this call is the probe
+            self._probing = True
+            return True
+
+    def _on_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def _on_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or (self._opened_at is None and self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self._probing = False
+                metrics.count('circuit_opened_total', breaker=self.name)
+
+    @staticmethod
+    def _is_upstream_failure(ex: Exception) -> bool:
+        # other client errors like 404 are valid answers of a working upstream
+        if isinstance(ex, urllib.error.HTTPError):
+            return ex.code == 429 or ex.code >= 500
+        return isinstance(ex, (OSError, http.client.HTTPException))
+
+    def call(self, func):
+        """call func() unless the breaker is open, raises CircuitOpenError if it is"""
+        if not self._allow():
+            metrics.count('circuit_rejected_total', breaker=self.name)
+            raise CircuitOpenError(f'{self.name} is unavailable')
+        start = time.monotonic()
+        try:
+            result = func()
+        except Exception as ex:
+            if self._is_upstream_failure(ex):
+                self._on_failure()
+            else:
+                self._on_success()
+            raise
+        if self.latency_budget is not None and time.monotonic() - start > self.latency_budget:
+            self._on_failure()
+        else:
+            self._on_success()
+        return result
+
+
+class RateLimitError(Exception):
+    """Raised when a rate limiter has no token available in time."""
+
+
+class RateLimiter:
+    """Token bucket rate limiter that can be shared between threads."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def after_fork(self, share=1):
+        """reset the lock after os.fork(), and keep only this process's share of the budget
+           when it is split between share processes"""
+        self.rate /= share
+        # at least one token, otherwise the bucket never allows a request
+        self.burst = max(1, self.burst / share)
+        self._tokens = min(self._tokens, self.burst)
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=None) -> bool:
+        """take one token, waiting up to timeout seconds (or forever if None) for one to be available"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False # no chance to get a token in time
+            time.sleep(wait)
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """Rate limiter that slows down when requests fail and speeds up again while they succeed."""
+
+    def __init__(self, rate: float, burst: int, min_rate: float, max_rate: float,
+                 increase=0.1, decrease=0.5):
+        super().__init__(rate, burst)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+
+    def on_success(self):
+        """report a successful request, slowly raises the rate"""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_error(self):
+        """report a failed or rate-limited request, quickly lowers the rate"""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            # stop bursting until the rate has recovered
+            self._tokens = min(self._tokens, 0)
+
+def upstream_metrics() -> list:
+    """return the request statistics of the shared client as counters for metrics.render()"""
+    with client._lock:
+        hosts = {host: dict(m) for host, m in client.metrics.items()}
+    return [(f'upstream_{field}_total', {'host': host}, value)
+            for host, m in hosts.items() for field, value in m.items()]
@@ -0,0 +1,160 @@
+"""Lightweight in-process metrics: counters and latency histograms, exported in the Prometheus text format.
+
+Each process keeps its own values, so with several worker processes every worker reports its own,
+labelled with its pid."""
+
+import os
+import time
+import random
+import cProfile
+import threading
+import traceback
+import functools
+import contextlib
+
+# upper bounds of the latency histogram buckets in seconds, from fast cache lookups to slow upstream requests
+_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# profile this fraction of requests with cProfile, and write the results into _PROFILE_DIR
+_PROFILE_RATE = float(os.environ.get('PROFILE_RATE', 0))
+_PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+
+_lock = threading.Lock()
+# only one profiler can be active at a time since python 3.12
+_profile_lock = threading.Lock()
+# (name, labels) -> value, labels are a sorted tuple of (key, value) pairs
+_counters = {}
+# (name, labels) -> [bucket counts..., sum]
+_histograms = {}
+
+
+def _reset_after_fork():
+    # another thread of the parent may have held the lock while forking
+    global _lock, _profile_lock
+    _lock = threading.Lock()
+    _profile_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+
+def count(name: str, n=1, **labels):
+    """add n to a counter"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + n
+
+
+def observe(name: str, seconds: float, **labels):
+    """record a duration in a histogram"""
+    key = _key(name, labels)
+    with _lock:
+        values = _histograms.get(key)
+        if not values:
+            values = _histograms[key] = [0] * (len(_BUCKETS) + 2)
+        for i, bound in enumerate(_BUCKETS):
+            if seconds <= bound:
+                values[i] += 1
+                break
+        else:
+            values[len(_BUCKETS)] += 1
+        values[-1] += seconds
+
+
+@contextlib.contextmanager
+def timer(name: str, **labels):
+    """record the duration of the with block in a histogram"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name: str, **labels):
+    """decorator that records the duration of every call in a histogram"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+def call_request(route: str, func, *args, **kwargs):
+    """call the handler of a request, timing it and profiling a sample of the requests if enabled"""
+    if _PROFILE_RATE and random.random() < _PROFILE_RATE and _profile_lock.acquire(blocking=False):
+        try:
+            return _call_profiled(route, func, *args, **kwargs)
+        finally:
+            _profile_lock.release()
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        observe('request_seconds', time.perf_counter() - start, route=route)
+
+
+def _call_profiled(route: str, func, *args, **kwargs):
+    try:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    except ValueError:
+        # another profiling tool is active, e.g. a debugger, so run the request unprofiled
+        profiler = None
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        observe('request_seconds', time.perf_counter() - start, route=route)
+        if profiler:
+            profiler.disable()
+            try:
+                os.makedirs(_PROFILE_DIR, exist_ok=True)
+                profiler.dump_stats(os.path.join(_PROFILE_DIR, f'{route}.{os.getpid()}.{time.time_ns()}.prof'))
+            except OSError:
+                traceback.print_exc()
+
+
+def _format_labels(labels: tuple, extra=()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{str(v)}"' for k, v in pairs) + '}'
+
+
+def render(extra_counters=()) -> str:
+    """return all metrics in the Prometheus text format,
+       extra_counters are (name, labels dict, value) tuples for values that are kept elsewhere"""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {k: list(v) for k, v in _histograms.items()}
+    for name, labels, value in extra_counters:
+        counters[_key(name, labels)] = value
+    # scrapes of a port shared by several workers land on any of them, the pid tells them apart
+    pid = [('pid', os.getpid())]
+    lines = []
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f'# TYPE {name} counter')
+        for (n, labels), value in sorted(counters.items()):
+            if n == name:
+                lines.append(f'{name}{_format_labels(labels, pid)} {value}')
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f'# TYPE {name} histogram')
+        for (n, labels), values in sorted(histograms.items()):
+            if n != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(_BUCKETS + ('+Inf',), values):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{_format_labels(labels, pid + [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels, pid)} {values[-1]}')
+            lines.append(f'{name}_count{_format_labels(labels, pid)} {cumulative}')
+    return '\n'.join(lines) + '\n'
@@ -1,6 +1,14 @@
 """Discord API client for game lists and random games, caches the game lists locally."""
 
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
+import bisect
+import hashlib
+import http.client
+import itertools
+import mmap
+import multiprocessing
 import shutil
 import sys
 import os
@@ -8,7 +16,206 @@ import json
 import random
 import time
 import re
+import struct
+import threading
+import traceback
+import zlib
+from array import array
+from collections import OrderedDict, deque
 import httputil
+import game_catalog
+import metrics
+
+class SystemIndex:
+    """Lookup table for matching system names by substrings or well-known aliases."""
+
+    def __init__(self, systems: list, aliases: dict):
+        self.aliases = {k.lower(): v.lower() for k, v in aliases.items()}
+        # every substring of every name, mapped to the shortest name containing it,
+        # which is the closest match. there are only ~100 systems, so this stays small.
+        self.substrings = {}
+        for system in systems:
+            name = system['Name'].lower()
+            for start in range(len(name)):
+                for end in range(start + 1, len(name) + 1):
+                    sub = name[start:end]
+                    best = self.substrings.get(sub)
+                    if not best or len(system['Name']) < len(best['Name']):
+                        self.substrings[sub] = system
+
+    def match(self, substr: str):
+        """return the system that is the closest match for the given substring"""
+        s = substr.strip().lower()
+        if not s:
+            return None
+        s = self.aliases.get(s, s)
+        return self.substrings.get(s)
+
+
+class PullHistory:
+    """Remembers the most recent pulls per channel, so that they can be excluded from the next pulls.
+       Bounded in guilds, channels per guild and games per channel, dropping the least recently used."""
+
+    def __init__(self, max_guilds=1000, max_channels=50, max_games=100):
+        self.max_guilds = max_guilds
+        self.max_channels = max_channels
+        self.max_games = max_games
+        # guild -> channel -> recent game ids, newest last
+        self._guilds = OrderedDict()
+        self._lock = threading.Lock()
+
+    def after_fork(self):
+        """reset the lock after os.fork()"""
+        self._lock = threading.Lock()
+
+    def recent(self, guild, channel, count: int) -> set:
+        """return the ids of up to count most recent pulls in the channel"""
+        with self._lock:
+            games = self._guilds.get(guild, {}).get(channel)
+            if not games or count <= 0:
+                return set()
+            return set(itertools.islice(reversed(games), count))
+
+    def add(self, guild, channel, game_ids: list):
+        """remember pulled games for the channel"""
+        with self._lock:
+            channels = self._guilds.setdefault(guild, OrderedDict())
+            self._guilds.move_to_end(guild)
+            while len(self._guilds) > self.max_guilds:
+                self._guilds.popitem(last=False)
+            games = channels.setdefault(channel, deque(maxlen=self.max_games))
+            channels.move_to_end(channel)
+            while len(channels) > self.max_channels:
+                channels.popitem(last=False)
+            games.extend(game_ids)
+
+
+class SharedPullHistory:
+    """PullHistory that is shared by the processes forked after creating it, kept in shared memory.
+       Bounded in channels and games per channel, a new channel replaces the least recently used
+       of the few slots it can be stored in."""
+
+    # channel key, time of the last pull, game count, next write position
+    _SLOT = struct.Struct('<QQII')
+    # number of slots a channel can be stored in
+    _PROBES = 8
+
+    def __init__(self, max_channels=16384, max_games=100):
+        self.max_channels = max_channels
+        self.max_games = max_games
+        self._games = struct.Struct(f'<{max_games}I')
+        self._slot_size = self._SLOT.size + self._games.size
+        # anonymous maps are shared with child processes, unlike the other memory
+        self._data = mmap.mmap(-1, max_channels * self._slot_size)
+        self._lock = multiprocessing.Lock()
+
+    def after_fork(self):
+        """nothing to reset, the lock is shared with the other processes"""
+
+    @staticmethod
+    def _key(guild, channel) -> int:
+        digest = hashlib.blake2b(f'{guild}/{channel}'.encode(), digest_size=8).digest()
+        # 0 marks free slots
+        return int.from_bytes(digest, 'little') or 1
+
+    def _find_slot(self, key: int, create: bool):
+        oldest = None
+        for i in range(self._PROBES):
+            offset = (key + i) % self.max_channels * self._slot_size
+            slot_key, last_pull, _, _ = self._SLOT.unpack_from(self._data, offset)
+            if slot_key == key:
+                return offset
+            if oldest is None or last_pull < oldest[1]:
+                oldest = offset, last_pull
+        if not create:
+            return None
+        self._SLOT.pack_into(self._data, oldest[0], key, 0, 0, 0)
+        return oldest[0]
+
+    def recent(self, guild, channel, count: int) -> set:
+        """return the ids of up to count most recent pulls in the channel"""
+        if count <= 0:
+            return set()
+        with self._lock:
+            offset = self._find_slot(self._key(guild, channel), False)
+            if offset is None:
+                return set()
+            _, _, game_count, pos = self._SLOT.unpack_from(self._data, offset)
+            games = self._games.unpack_from(self._data, offset + self._SLOT.size)
+        return {games[(pos - 1 - i) % self.max_games] for i in range(min(count, game_count))}
+
+    def add(self, guild, channel, game_ids: list):
+        """remember pulled games for the channel"""
+        key = self._key(guild, channel)
+        game_ids = game_ids[-self.max_games:]
+        with self._lock:
+            offset = self._find_slot(key, True)
+            _, _, game_count, pos = self._SLOT.unpack_from(self._data, offset)
+            games = list(self._games.unpack_from(self._data, offset + self._SLOT.size))
+            for game_id in game_ids:
+                games[pos] = game_id
+                pos = (pos + 1) % self.max_games
+            self._games.pack_into(self._data, offset + self._SLOT.size, *games)
+            self._SLOT.pack_into(self._data, offset, key, time.monotonic_ns(),
+                                 min(self.max_games, game_count + len(game_ids)), pos)
+
+
+class GameDb:
+    """Immutable snapshot of the loaded game lists, replaced as a whole when the cache changes."""
+
+    def __init__(self, catalog: game_catalog.GameCatalog, system_index: SystemIndex):
+        self.catalog = catalog
+        self.system_index = system_index
+        self.all_games = catalog.all_games()
+        self.all_nonempty_games = catalog.nonempty_games()
+        # games per ConsoleID, bucketed by (has achievements, is hack)
+        self.system_games = {}
+        for (nonempty, is_hack, sysid), games in catalog.buckets.items():
+            self.system_games.setdefault(sysid, {})[(nonempty, is_hack)] = games
+        # games for each (allow_empty, allow_hacks) pull option, partitioned once per snapshot
+        self.pools = {}
+        for allow_empty in (False, True):
+            for allow_hacks in (False, True):
+                matches = [games for (nonempty, is_hack, _), games in catalog.buckets.items()
+                           if (nonempty or allow_empty) and (allow_hacks or not is_hack)]
+                self.pools[(allow_empty, allow_hacks)] = game_catalog.merge_adjacent(matches)
+        self.stats = self._count_games(catalog)
+        # mtime of systems.json when the snapshot was loaded
+        self.timestamp = catalog.timestamp
+        # counts up with every snapshot that is published, for invalidating derived data
+        self.generation = 0
+        # cumulative achievement weights per list of games, (start, end) -> array, built on first use
+        self._weight_tables = {}
+        # prepared draws for pulls without a system filter, (allow_empty, allow_hacks, weighting) -> groups
+        self.draw_tables = {}
+
+    def get_achievement_weights(self, games: game_catalog.GameList) -> array:
+        """return the cumulative weights of the games for weighting by achievement count.
+           every game has a weight of achievements + 1, so that games without achievements can still be pulled"""
+        key = (games.start, games.end)
+        table = self._weight_tables.get(key)
+        if table is None:
+            counts = games.catalog.num_achievements[games.start:games.end]
+            table = array('q', itertools.accumulate(c + 1 for c in counts))
+            # concurrent callers may build the same table, but the result is identical
+            self._weight_tables[key] = table
+        return table
+
+    @staticmethod
+    def _count_games(catalog: game_catalog.GameCatalog):
+        result = {}
+        all_total = 0
+        all_nonempty = 0
+        # the catalog already groups the games, so only the group sizes have to be added up
+        for (is_nonempty, _, _), games in catalog.buckets.items():
+            key = games[0].console_name
+            total, nonempty = result.get(key, (0, 0))
+            count = len(games)
+            result[key] = (total + count, nonempty + count * is_nonempty)
+            all_total += count
+            all_nonempty += count * is_nonempty
+        return result, (all_total, all_nonempty)
+
 
 class RetroAchievementsApi:
     """Discord API client for game lists and random games, caches the game lists locally."""
@@ -17,14 +224,36 @@ class RetroAchievementsApi:
     _API_URL = _BASE_URL + 'API/'
     _SUBSET_RE = re.compile(r'\[Subset[^\]]+\]$')
     _HACK_STR = '~Hack~'
+    _MANIFEST = 'manifest.json'
+    _CATALOG = 'catalog.bin'
+    # how to choose random games: every game equally likely, more likely with more achievements,
+    # or every system equally likely
+    WEIGHTINGS = ('uniform', 'achievements', 'system')
+    # give up on excluding games after this many rejected draws per requested game
+    _MAX_DRAWS_PER_GAME = 100
 
-    def __init__(self, user: str, key: str, cache_dir: str):
+    def __init__(self, user: str, key: str, cache_dir: str,
+                 detail_cache_size=1024, detail_cache_ttl=24*3600, detail_stale_ttl=0, detail_cache_dir=None,
+                 detail_rate=1.0, detail_burst=8, detail_workers=4, reload_interval=10.0,
+                 detail_failure_threshold=5, detail_reset_timeout=30.0, detail_latency_budget=None):
         self.auth_user = user
         self.auth_key = key
         self.cache_dir = cache_dir
-        self.all_games = None
-        self.all_nonempty_games = None
-        self.db_timestamp = 0
+        # game details change rarely, but are requested for every pull and quickly run into rate limits
+        self.detail_cache = httputil.TtlCache(detail_cache_size, detail_cache_ttl,
+                                              detail_stale_ttl, detail_cache_dir, name='game_details')
+        # RA starts rate-limiting after a few requests, so share one budget between all requests
+        self.detail_limiter = httputil.RateLimiter(detail_rate, detail_burst)
+        # while RA is down or too slow, pulls are sent with cached or without details instead of waiting
+        self.detail_breaker = httputil.CircuitBreaker('ra_details', detail_failure_threshold,
+                                                      detail_reset_timeout, detail_latency_budget)
+        self.detail_workers = detail_workers
+        self.detail_pool = ThreadPoolExecutor(max_workers=detail_workers)
+        self.db = None
+        # check for a changed cache at most every few seconds
+        self.reload_interval = reload_interval
+        self._last_reload_check = 0
+        self._reload_lock = threading.Lock()
         # some short well-known aliases to make system filtering easier
         with open('system_aliases.json', 'rb') as f:
             self.system_aliases = json.load(f)
@@ -36,28 +265,92 @@ class RetroAchievementsApi:
         # scrape date: 2024-05-02
         with open('mature_games.json', 'rb') as f:
             self.mature_games = {int(x) for x in json.load(f)}
+        # a catalog snapshot is outdated if it was built with a different list of ignored games
+        self.filter_crc = zlib.crc32(json.dumps(sorted(self.mature_games)).encode())
+
+    def _get_db_timestamp(self) -> float:
+        try:
+            return os.stat(os.path.join(self.cache_dir, 'systems.json')).st_mtime
+        except FileNotFoundError:
+            return 0
 
-    def _load_db(self):
-        path = os.path.join(self.cache_dir, 'systems.json')
-        if os.path.exists(path):
-            mtime = os.stat(path).st_mtime
-            if mtime == self.db_timestamp:
-                return # already loaded
-            self.db_timestamp = mtime
+    @metrics.timed('build_db_seconds')
+    def _build_db(self) -> GameDb:
         print('reload db')
-        self.all_games = []
-        self.all_nonempty_games = []
-        for system in self.get_systems():
+        catalog_path = os.path.join(self.cache_dir, self._CATALOG)
+        timestamp = self._get_db_timestamp()
+        systems = self.get_systems()
+        system_index = SystemIndex(systems, self.system_aliases)
+        catalog = game_catalog.load_catalog(catalog_path)
+        if timestamp and catalog and (catalog.timestamp, catalog.filter_crc) == (timestamp, self.filter_crc):
+            return GameDb(catalog, system_index)
+        all_games = []
+        timestamp = self._get_db_timestamp()
+        for system in systems:
             sysid = int(system['ID'])
             # ignore non-game systems, like "Hubs" and "Events"
             if sysid >= 100:
                 continue
             for game in self.get_gamelist(sysid):
-                if self._is_ignored_game(game):
-                    continue
-                if game["NumAchievements"]:
-                    self.all_nonempty_games.append(game)
-                self.all_games.append(game)
+                if not self._is_ignored_game(game):
+                    all_games.append(game)
+        data = game_catalog.encode_catalog(all_games, self._HACK_STR, timestamp, self.filter_crc)
+        # store the snapshot, so that other processes can map it instead of parsing the json again
+        try:
+            game_catalog.write_catalog(catalog_path, data)
+        except OSError:
+            traceback.print_exc()
+        return GameDb(game_catalog.load_catalog(catalog_path) or game_catalog.GameCatalog(data), system_index)
+
+    def _publish_db(self, db: GameDb):
+        db.generation = self.db.generation + 1 if self.db else 1
+        # a single reference swap, readers keep using the snapshot they already got
+        self.db = db
+
+    def _reload_db(self):
+        try:
+            self._publish_db(self._build_db())
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self._reload_lock.release()
+
+    @metrics.timed('load_db_seconds')
+    def _load_db(self) -> GameDb:
+        """return the current snapshot of the game lists, loads it on first use
+           and reloads it in the background when the cache was changed"""
+        db = self.db
+        if not db:
+            with self._reload_lock:
+                if not self.db:
+                    self._publish_db(self._build_db())
+            return self.db
+        if time.monotonic() - self._last_reload_check >= self.reload_interval:
+            self.check_for_update()
+        return db
+
+    def check_for_update(self) -> bool:
+        """start reloading the game lists in the background if the cache was changed,
+           returns True if a reload was started"""
+        self._last_reload_check = time.monotonic()
+        db = self.db
+        if not db or self._get_db_timestamp() == db.timestamp:
+            return False
+        if not self._reload_lock.acquire(blocking=False):
+            return False # already reloading
+        threading.Thread(target=self._reload_db, daemon=True).start()
+        return True
+
+    def after_fork(self, worker_count=1):
+        """reset the state that can't be inherited from the parent process after os.fork(),
+           worker_count is the number of processes that share the detail request budget"""
+        self._reload_lock = threading.Lock()
+        # worker threads of the parent don't exist in the child
+        self.detail_pool = ThreadPoolExecutor(max_workers=self.detail_workers)
+        self.detail_cache.after_fork()
+        self.detail_breaker.after_fork()
+        # RA limits the requests of the api key, not of the process
+        self.detail_limiter.after_fork(worker_count)
 
     def _is_ignored_game(self, game: dict):
         if game['ID'] in self.mature_games:
@@ -68,85 +361,207 @@ class RetroAchievementsApi:
             return True
         return False
 
-    def _request(self, url: str, args=None, cache_path=None, ignore_error=False):
+    def _request(self, url: str, args=None, cache_path=None, ignore_error=False, revalidate=False):
         full_url = self._API_URL + url + f'?z={self.auth_user}&y={self.auth_key}'
         if args:
             full_url += '&'
             full_url += args
         full_cache_path = os.path.join(self.cache_dir, cache_path) if cache_path else None
-        return httputil.cached_request(full_url, full_cache_path, ignore_error=ignore_error)
+        return httputil.cached_request(full_url, full_cache_path, ignore_error=ignore_error,
+                                       revalidate=revalidate)
 
     def get_systems(self):
         """get the list of known systems"""
         return self._request('API_GetConsoleIDs.php', cache_path='systems.json')
 
-    def get_gamelist(self, system_id: int):
-        """get the game list for a specific system"""
+    def get_gamelist(self, system_id: int, revalidate=False):
+        """get the game list for a specific system, revalidate=True checks if the cached list is outdated"""
         sysid = int(system_id)
         cache_path = os.path.join('gamelist', f'{sysid}.json')
         # will also return games without achievements
-        return self._request('API_GetGameList.php', f'i={sysid}', cache_path=cache_path)
+        return self._request('API_GetGameList.php', f'i={sysid}', cache_path=cache_path,
+                             revalidate=revalidate)
 
-    def get_game_details(self, game_id: int, ignore_error=False):
-        """get details for a game, will not be cached"""
+    @metrics.timed('game_details_seconds')
+    def get_game_details(self, game_id: int, ignore_error=False, limit_timeout=None):
+        """get details for a game, cached for a limited time.
+           waits up to limit_timeout seconds (or forever if None) when rate-limited.
+           with ignore_error=True, returns None instead of raising when RA fails or is unavailable.
+           concurrent calls for the same game share one request, and each caller handles its failure
+           according to its own ignore_error"""
         gid = int(game_id)
-        return self._request('API_GetGame.php', f'i={gid}', ignore_error=ignore_error)
+        if self.detail_breaker.is_open():
+            # don't wait for RA, use whatever was cached before, even if it is outdated
+            cached = self.detail_cache.peek(str(gid))
+            if cached is not None or ignore_error:
+                return cached
+            raise httputil.CircuitOpenError('RetroAchievements is unavailable')
+        def fetch():
+            # always raise, the failure may be shared with callers that don't ignore errors
+            if not self.detail_limiter.acquire(limit_timeout):
+                metrics.count('detail_rate_limited_total')
+                raise httputil.RateLimitError('rate limit exceeded')
+            return self.detail_breaker.call(lambda: self._request('API_GetGame.php', f'i={gid}'))
+        try:
+            return self.detail_cache.get(str(gid), fetch)
+        except (httputil.RateLimitError, httputil.CircuitOpenError, OSError, http.client.HTTPException):
+            if ignore_error:
+                return None
+            raise
+
+    def get_many_game_details(self, game_ids: list, timeout: float) -> dict:
+        """get details for several games concurrently, returns a dict from game id to details
+           for those that could be fetched within the timeout"""
+        if self.detail_breaker.is_open():
+            # skip the pool, its workers may all be blocked on RA
+            cached = {gid: self.detail_cache.peek(str(int(gid))) for gid in game_ids}
+            return {gid: details for gid, details in cached.items() if details}
+        deadline = time.monotonic() + timeout
+        def fetch(gid):
+            # requests that were queued behind others may not wait for the full timeout
+            return self.get_game_details(gid, True, max(0, deadline - time.monotonic()))
+        futures = {self.detail_pool.submit(fetch, gid): gid for gid in game_ids}
+        done, _ = concurrent.futures.wait(futures, timeout=max(0, deadline - time.monotonic()))
+        result = {}
+        for future in done:
+            if not future.exception() and future.result():
+                result[futures[future]] = future.result()
+        return result
 
     def get_full_gamelist(self, allow_empty=False) -> list:
         """get the full list of games with achievements, or of any games if allow_empty=True"""
-        self._load_db()
+        db = self._load_db()
         if allow_empty:
-            return self.all_games
+            return db.all_games
         else:
-            return self.all_nonempty_games
-
-    def _filter_hacks(self, games: list, get_more, max_iterations=10) -> list:
-        target_count = len(games)
-        for _ in range(max_iterations):
-            # filter the list in-place
-            for i in range(len(games) - 1, -1, -1):
-                g = games[i]
-                if self._HACK_STR in g['Title']:
-                    games.pop(i)
-            if len(games) >= target_count:
-                break
-            # re-fill to desired length
-            missing_count = target_count - len(games)
-            more_games = get_more(missing_count)
-            ids = [r['ID'] for r in games]
-            for g in more_games:
-                if g['ID'] not in ids:
-                    games.append(g)
+            return db.all_nonempty_games
+
+    @staticmethod
+    def _get_system_buckets(db: GameDb, systems, allow_empty: bool, allow_hacks: bool) -> list:
+        buckets = []
+        for sysid in set(int(x) for x in systems):
+            system_buckets = db.system_games.get(sysid, {})
+            for (nonempty, is_hack), games in system_buckets.items():
+                if (nonempty or allow_empty) and (allow_hacks or not is_hack):
+                    buckets.append(games)
+        return buckets
+
+    @staticmethod
+    def _iter_sample_buckets(buckets: list, count: int):
+        """sample unique games from several lists as if they were one list, without copying them.
+           returns a generator that creates the games on demand, and at most as many as there are"""
+        offsets = list(itertools.accumulate(len(b) for b in buckets))
+        total = offsets[-1] if offsets else 0
+        indexes = random.sample(range(total), min(count, total))
+        def generate():
+            for idx in indexes:
+                i = bisect.bisect_right(offsets, idx)
+                start = offsets[i - 1] if i else 0
+                yield buckets[i][idx - start]
+        return generate()
+
+    @classmethod
+    def _sample_buckets(cls, buckets: list, count: int) -> list:
+        """sample unique games from several lists as if they were one list, without copying them"""
+        result = list(cls._iter_sample_buckets(buckets, count))
+        if len(result) < count:
+            raise Exception(f'game list is shorter than requested count ({len(result)} < {count})')
+        return result
+
+    @staticmethod
+    def _prepare_draw(db: GameDb, buckets: list, weighting: str) -> tuple:
+        """group the buckets and sum up their weights for drawing games.
+           returns a list of (buckets, cumulative weights) and the number of games"""
+        if weighting == 'system':
+            # every system is equally likely, no matter how many games it has
+            groups = {}
+            for games in buckets:
+                groups.setdefault(games.catalog.console_ids[games.start], []).append(games)
+            groups = list(groups.values())
+        else:
+            groups = [buckets]
+        def weight(games):
+            return db.get_achievement_weights(games)[-1] if weighting == 'achievements' else len(games)
+        prepared = [(group, list(itertools.accumulate(weight(g) for g in group))) for group in groups if group]
+        return prepared, sum(len(b) for b in buckets)
+
+    @classmethod
+    def _sample_weighted(cls, db: GameDb, prepared: tuple, count: int, weighting: str, exclude) -> list:
+        """sample unique games with the given weighting, avoiding excluded game ids if possible"""
+        groups, total = prepared
+        if total < count:
+            raise Exception(f'game list is shorter than requested count ({total} < {count})')
+        def draw():
+            group, offsets = random.choice(groups)
+            r = random.randrange(offsets[-1])
+            i = bisect.bisect_right(offsets, r)
+            games = group[i]
+            r -= offsets[i - 1] if i else 0
+            if weighting == 'achievements':
+                r = bisect.bisect_right(db.get_achievement_weights(games), r)
+            return games[r]
+        result = []
+        seen = set()
+        # draws are rejected until enough unique games were found, this is fast as long as the pulls
+        # are small compared to the list. if too many draws fail, allow excluded games again.
+        for avoid in (exclude, ()):
+            for _ in range(count * cls._MAX_DRAWS_PER_GAME):
+                if len(result) == count:
+                    return result
+                game = draw()
+                if game.id not in seen and game.id not in avoid:
+                    seen.add(game.id)
+                    result.append(game)
+        if len(result) < count:
+            raise Exception('not enough games to choose from')
+        return result
 
     def match_system(self, substr: str):
         """return the system that is the closest match for the given substring"""
-        s = substr.strip().lower()
-        if not s:
-            return None
-        alias = self.system_aliases.get(s)
-        if alias:
-            s = alias.lower()
-        matches = [x for x in self.get_systems() if s in x['Name'].lower()]
-        if not matches:
-            return None
-        return min(matches, key=lambda x: len(x['Name']) - len(s))
+        return self._load_db().system_index.match(substr)
 
-    def get_random_games(self, game_count=1, allow_empty=False, allow_hacks=True, systems=None) -> list:
+    @metrics.timed('random_games_seconds')
+    def get_random_games(self, game_count=1, allow_empty=False, allow_hacks=True, systems=None,
+                         weighting='uniform', exclude=()) -> list:
         """return random games from the cached game list,
-           either only games with achievements, or any game when allow_empty=True"""
-        games = self.get_full_gamelist(allow_empty)
+           either only games with achievements, or any game when allow_empty=True.
+           weighting is one of WEIGHTINGS, games with ids in exclude are avoided unless there are too few others"""
+        if weighting not in self.WEIGHTINGS:
+            raise ValueError(f'unknown weighting {weighting}')
+        db = self._load_db()
+        if weighting == 'uniform' and not exclude:
+            # hacks are already separated in the buckets and pools, no need to filter afterwards
+            if systems:
+                buckets = self._get_system_buckets(db, systems, allow_empty, allow_hacks)
+            else:
+                buckets = db.pools[(bool(allow_empty), bool(allow_hacks))]
+            return self._sample_buckets(buckets, game_count)
+        # the weights for pulls without a system filter are only summed up once per snapshot
+        cache_key = None if systems else (bool(allow_empty), bool(allow_hacks), weighting)
+        prepared = db.draw_tables.get(cache_key)
+        if not prepared:
+            if systems or weighting == 'system':
+                buckets = self._get_system_buckets(db, systems or db.system_games.keys(), allow_empty, allow_hacks)
+            else:
+                buckets = db.pools[(bool(allow_empty), bool(allow_hacks))]
+            prepared = self._prepare_draw(db, buckets, weighting)
+            if cache_key:
+                db.draw_tables[cache_key] = prepared
+        return self._sample_weighted(db, prepared, game_count, weighting, exclude)
+
+    def iter_random_games(self, game_count: int, allow_empty=False, allow_hacks=True, systems=None):
+        """like get_random_games, but returns a generator that creates the games one by one,
+           for pulling large numbers of games. yields all matching games if there are fewer than game_count"""
+        db = self._load_db()
         if systems:
-            # not sure whether I want to cache these lists
-            games = [g for g in games if g['ConsoleID'] in systems]
-        def sample(count):
-            if len(games) < count:
-                raise Exception(f'game list is shorter than requested count ({len(games)} < {count})')
-            return random.sample(games, count)
-        result = sample(game_count)
-        # filter out hacks and then non-unique pulls until we have enough again
-        if not allow_hacks:
-            self._filter_hacks(result, sample)
-        return result
+            buckets = self._get_system_buckets(db, systems, allow_empty, allow_hacks)
+        else:
+            buckets = db.pools[(bool(allow_empty), bool(allow_hacks))]
+        return self._iter_sample_buckets(buckets, game_count)
+
+    def get_cached_game_details(self, game_id: int):
+        """return the details of a game if they are cached, regardless of their age, without requesting them"""
+        return self.detail_cache.peek(str(int(game_id)))
 
     def make_full_url(self, relative_url: str) -> str:
         """return a full url for the relative urls returned by the API, e.g. for images"""
@@ -160,66 +575,180 @@ class RetroAchievementsApi:
 
     def stats(self):
         """return a dict with total and nonempty game counts per system"""
-        result = {}
-        games = self.get_full_gamelist(allow_empty=True)
-        all_total = 0
-        all_nonempty = 0
-        for game in games:
-            key = game['ConsoleName']
-            total, nonempty = result.get(key, (0, 0))
-            is_nonempty = int(bool(game['NumAchievements']))
-            result[key] = (total + 1, nonempty + is_nonempty)
-            all_total += 1
-            all_nonempty += is_nonempty
-        return result, (all_total, all_nonempty)
+        return self._load_db().stats
+
+    def get_db_generation(self) -> int:
+        """return a number that changes whenever a different game db is loaded"""
+        return self._load_db().generation
 
     def get_update_timestamp(self):
         """Get an ISO date and time string for when the db cache was updated."""
-        path = os.path.join(self.cache_dir, 'systems.json')
-        if os.path.exists(path):
-            mtime = os.stat(path).st_mtime
+        mtime = self._load_db().timestamp
+        if mtime:
             dt = datetime.fromtimestamp(mtime)
             return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
         return None
 
-    def update_cache(self):
-        """Download the cached database files again and replace the old database."""
+    def _read_manifest(self) -> dict:
+        """return game count and content hash per system id (as string) that was completely downloaded"""
+        try:
+            with open(os.path.join(self.cache_dir, self._MANIFEST), 'rb') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_manifest(self, manifest: dict):
+        path = os.path.join(self.cache_dir, self._MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(path + '.tmp', path)
+
+    def _seed_gamelist(self, old_dir: str, sysid: int):
+        """start from the game list of the previous db, so that unchanged lists are not rewritten"""
+        rel_path = os.path.join('gamelist', f'{sysid}.json')
+        for suffix in ['', '.meta']:
+            # a partial download from an interrupted run can't be trusted
+            dst = os.path.join(self.cache_dir, rel_path + suffix)
+            if os.path.exists(dst):
+                os.remove(dst)
+            src = os.path.join(old_dir, rel_path + suffix)
+            if os.path.exists(src):
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                try:
+                    os.link(src, dst)
+                except OSError:
+                    shutil.copy2(src, dst)
+
+    def _update_gamelist(self, system: dict, limiter, retries: int, old_dir: str):
+        sysid = int(system['ID'])
+        self._seed_gamelist(old_dir, sysid)
+        cache_path = os.path.join(self.cache_dir, 'gamelist', f'{sysid}.json')
+        for attempt in range(retries + 1):
+            limiter.acquire()
+            try:
+                games = self.get_gamelist(sysid, revalidate=True)
+                limiter.on_success()
+                with open(cache_path, 'rb') as f:
+                    content_hash = hashlib.sha1(f.read()).hexdigest()
+                return {'games': len(games), 'sha1': content_hash, 'fetched': time.time()}
+            except (OSError, ValueError) as ex:
+                limiter.on_error()
+                print('failed system', sysid, system['Name'], 'attempt', attempt + 1, ':', ex)
+        return None
+
+    def _can_reuse_gamelist(self, system: dict, old_entry, max_age: float) -> bool:
+        """RA has no way to ask which systems changed, so only skip the download for
+           systems that were fetched less than max_age seconds ago, or that are inactive"""
+        if not old_entry or 'fetched' not in old_entry:
+            return False
+        return system.get('Active') is False or time.time() - old_entry['fetched'] < max_age
+
+    def update_cache(self, workers=4, rate=1.0, max_rate=5.0, retries=5, max_age=0):
+        """Download the cached database files again and replace the old database.
+           An interrupted update resumes and only downloads the missing systems.
+           Game lists of inactive systems and of systems fetched less than max_age seconds ago
+           are reused from the old database without a request."""
         update_dir = self.cache_dir + '.update'
         new_db = RetroAchievementsApi(self.auth_user, self.auth_key, update_dir)
         systems = new_db.get_systems()
-        for system in systems:
-            games = new_db.get_gamelist(system['ID'])
-            print('updated system', system['ID'], system['Name'], 'has', len(games), 'games')
-            # the RA API has heavy rate limiting, wait between requests
-            time.sleep(1)
+        old_manifest = self._read_manifest()
+        manifest = new_db._read_manifest()
+        missing = [s for s in systems if str(s['ID']) not in manifest]
+        print(len(systems) - len(missing), 'systems already updated,', len(missing), 'missing')
+        # the RA API has heavy rate limiting, adapt to how much it allows right now
+        limiter = httputil.AdaptiveRateLimiter(rate, workers, min_rate=0.1, max_rate=max_rate)
+        lock = threading.Lock()
+        failed = []
+        def update_system(system):
+            key = str(system['ID'])
+            if self._can_reuse_gamelist(system, old_manifest.get(key), max_age):
+                new_db._seed_gamelist(self.cache_dir, int(system['ID']))
+                with lock:
+                    manifest[key] = old_manifest[key]
+                    new_db._write_manifest(manifest)
+                print('reused system', system['ID'], system['Name'])
+                return
+            entry = new_db._update_gamelist(system, limiter, retries, self.cache_dir)
+            with lock:
+                if entry is None:
+                    failed.append(system)
+                    return
+                manifest[key] = entry
+                new_db._write_manifest(manifest)
+            old_entry = old_manifest.get(key) or {}
+            unchanged = (old_entry.get('games'), old_entry.get('sha1')) == (entry['games'], entry['sha1'])
+            status = 'unchanged' if unchanged else 'updated'
+            print(status, 'system', system['ID'], system['Name'], 'has', entry['games'], 'games')
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(update_system, missing))
+        if failed:
+            raise Exception(f'{len(failed)} systems failed to update, run the update again to resume')
         new_db._load_db()
-        print('total', len(new_db.all_games), 'games,', len(new_db.all_nonempty_games), 'with achievements')
-        # now replace the old data (apparently you can't atomically replace it easily)
-        old_dir = self.cache_dir + '.old'
-        os.rename(self.cache_dir, old_dir)
-        os.rename(update_dir, self.cache_dir)
-        shutil.rmtree(old_dir)
-        self.all_games = new_db.all_games
-        self.all_nonempty_games = new_db.all_nonempty_games
+        print('total', len(new_db.db.all_games), 'games,', len(new_db.db.all_nonempty_games), 'with achievements')
+        version_dir = f'{self.cache_dir}.{time.time_ns()}'
+        os.rename(update_dir, version_dir)
+        self._switch_db_dir(version_dir)
+        self._publish_db(new_db.db)
+
+    def _switch_db_dir(self, new_dir: str):
+        """point the cache dir to the new db dir, and remove outdated db dirs"""
+        parent_dir = os.path.dirname(os.path.abspath(self.cache_dir))
+        previous_dir = os.path.realpath(self.cache_dir)
+        if os.path.isdir(self.cache_dir) and not os.path.islink(self.cache_dir):
+            # migrate from a plain directory to a symlink, only happens once
+            previous_dir = os.path.realpath(self.cache_dir + '.0')
+            os.rename(self.cache_dir, previous_dir)
+        tmp_link = self.cache_dir + '.link'
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        try:
+            os.symlink(os.path.basename(new_dir), tmp_link, target_is_directory=True)
+        except OSError:
+            # symlinks may need extra permissions on windows, fall back to renaming
+            if os.path.lexists(self.cache_dir):
+                os.rename(self.cache_dir, self.cache_dir + '.old')
+            os.rename(new_dir, self.cache_dir)
+            shutil.rmtree(self.cache_dir + '.old', ignore_errors=True)
+            return
+        # replacing the link is atomic, readers either see the old or the new dir
+        os.replace(tmp_link, self.cache_dir)
+        # keep the previous db for readers that are still using it
+        keep = {os.path.realpath(new_dir), previous_dir}
+        version_re = re.compile(re.escape(os.path.basename(self.cache_dir)) + r'\.\d+$')
+        for name in os.listdir(parent_dir):
+            path = os.path.join(parent_dir, name)
+            if version_re.match(name) and os.path.realpath(path) not in keep:
+                shutil.rmtree(path)
 
 
 def get_api():
     """Create a new RetroAchievementsApi instance with configuration from ra_config.json."""
     with open('ra_config.json', 'rb') as f:
         cfg = json.load(f)
-    return RetroAchievementsApi(cfg['api_user'], cfg['api_key'], 'db')
+    return RetroAchievementsApi(cfg['api_user'], cfg['api_key'], 'db',
+                                detail_cache_size=cfg.get('detail_cache_size', 1024),
+                                detail_cache_ttl=cfg.get('detail_cache_ttl', 24*3600),
+                                detail_stale_ttl=cfg.get('detail_stale_ttl', 7*24*3600),
+                                detail_cache_dir=cfg.get('detail_cache_dir', 'details'),
+                                detail_rate=cfg.get('detail_rate', 1.0),
+                                detail_burst=cfg.get('detail_burst', 8),
+                                detail_workers=cfg.get('detail_workers', 4),
+                                reload_interval=cfg.get('reload_interval', 10.0),
+                                detail_failure_threshold=cfg.get('detail_failure_threshold', 5),
+                                detail_reset_timeout=cfg.get('detail_reset_timeout', 30.0),
+                                detail_latency_budget=cfg.get('detail_latency_budget', 2.0))
 
 def main():
     """main entry point if script is called directly."""
     cmd = sys.argv[1] if len(sys.argv) > 1 else None
-    count = int(sys.argv[2]) if len(sys.argv) > 2 else 1
     api = get_api()
-    if cmd == 'random':
-        print(*api.get_random_games(count, allow_empty=False), sep='\n')
-    elif cmd == 'any':
-        print(*api.get_random_games(count, allow_empty=True), sep='\n')
+    if cmd in ('random', 'any'):
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+        print(*api.get_random_games(count, allow_empty=cmd == 'any'), sep='\n')
     elif cmd == 'update':
-        api.update_cache()
+        # optional: hours during which a downloaded game list is reused
+        max_age_hours = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+        api.update_cache(max_age=max_age_hours * 3600)
     elif cmd == 'stats':
         stats, (total, nonempty) = api.stats()
         print('System | All Games | Games With Achievements')
@@ -0,0 +1,76 @@
+"""Tests for the binary game catalog format.
+Run from the repository directory: python -m pytest test_game_catalog.py"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import game_catalog
+
+_HACK_STR = '~Hack~'
+
+
+def _game(game_id, title, console_id, console_name, num_achievements):
+    return {'ID': game_id, 'Title': title, 'ConsoleID': console_id, 'ConsoleName': console_name,
+            'ImageIcon': f'/Images/{game_id:06d}.png', 'NumAchievements': num_achievements}
+
+
+_GAMES = [
+    _game(1, 'Alpha', 7, 'NES/Famicom', 10),
+    _game(2, 'Beta', 7, 'NES/Famicom', 0),
+    _game(3, '~Hack~ Gamma', 7, 'NES/Famicom', 5),
+    _game(4, 'Delta ★', 1, 'Mega Drive', 20),
+    _game(5, 'Epsilon', 1, 'Mega Drive', None),
+    _game(6, 'Zeta', 7, 'NES/Famicom', 3),
+]
+
+
+class GameCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'catalog.bin')
+        self.data = game_catalog.encode_catalog(_GAMES, _HACK_STR, 1234.5, 42)
+        game_catalog.write_catalog(self.path, self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_round_trip(self):
+        catalog = game_catalog.load_catalog(self.path)
+        self.assertEqual((catalog.game_count, catalog.timestamp, catalog.filter_crc), (6, 1234.5, 42))
+        games = {g.id: g for g in catalog.all_games()}
+        self.assertEqual(sorted(games), [1, 2, 3, 4, 5, 6])
+        delta = games[4]
+        self.assertEqual((delta.title, delta.console_id, delta.console_name, delta.image_icon,
+                          delta.num_achievements), ('Delta ★', 1, 'Mega Drive', '/Images/000004.png', 20))
+        self.assertEqual(games[5].num_achievements, 0)
+        # console names are stored once in the string table
+        self.assertEqual(len({catalog.console_names[i] for i in range(catalog.game_count)}), 2)
+
+    def test_buckets(self):
+        catalog = game_catalog.load_catalog(self.path)
+        buckets = {key: sorted(g.id for g in games) for key, games in catalog.buckets.items()}
+        self.assertEqual(buckets, {
+            (False, False, 1): [5],
+            (False, False, 7): [2],
+            (True, False, 1): [4],
+            (True, False, 7): [1, 6],
+            (True, True, 7): [3],
+        })
+        # games without achievements are sorted first
+        self.assertEqual(catalog.nonempty_start, 2)
+        self.assertEqual(sorted(g.id for g in catalog.nonempty_games()), [1, 3, 4, 6])
+
+    def test_truncated_file(self):
+        for size in (0, 10, len(self.data) // 2, len(self.data) - 1):
+            with open(self.path, 'wb') as f:
+                f.write(self.data[:size])
+            self.assertIsNone(game_catalog.load_catalog(self.path), size)
+
+    def test_missing_file(self):
+        self.assertIsNone(game_catalog.load_catalog(os.path.join(self.tmp_dir, 'missing.bin')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+"""Tests for the random game sampling and the pull history of ra_api.
+Run from the repository directory: python -m pytest test_ra_api.py"""
+
+import io
+import os
+import random
+import shutil
+import tempfile
+import contextlib
+import unittest
+import ra_api
+import trophytroopa_bench
+
+
+class SharedPullHistoryTest(unittest.TestCase):
+
+    def test_recent_wraps_around(self):
+        history = ra_api.SharedPullHistory(max_channels=16, max_games=5)
+        history.add('guild', 'channel', [1, 2, 3])
+        history.add('guild', 'channel', [4, 5, 6, 7])
+        self.assertEqual(history.recent('guild', 'channel', 3), {5, 6, 7})
+        self.assertEqual(history.recent('guild', 'channel', 10), {3, 4, 5, 6, 7})
+        self.assertEqual(history.recent('guild', 'channel', 0), set())
+        self.assertEqual(history.recent('guild', 'other', 3), set())
+        # a pull larger than the history only keeps its last games
+        history.add('guild', 'channel', list(range(10, 20)))
+        self.assertEqual(history.recent('guild', 'channel', 10), {15, 16, 17, 18, 19})
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs os.fork()')
+    def test_shared_after_fork(self):
+        history = ra_api.SharedPullHistory(max_channels=16, max_games=5)
+        history.add('guild', 'parent', [1])
+        pid = os.fork()
+        if pid == 0:
+            ok = False
+            try:
+                history.after_fork()
+                ok = history.recent('guild', 'parent', 5) == {1}
+                history.add('guild', 'child', [2, 3])
+            finally:
+                os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertEqual(history.recent('guild', 'child', 5), {2, 3})
+
+    def test_evicts_least_recently_pulled_channel(self):
+        # with as many probes as slots, every channel can use every slot
+        history = ra_api.SharedPullHistory(max_channels=ra_api.SharedPullHistory._PROBES, max_games=5)
+        channels = [f'channel {i}' for i in range(history.max_channels)]
+        for i, channel in enumerate(channels):
+            history.add('guild', channel, [i])
+        history.add('guild', channels[0], [100])
+        history.add('guild', 'new channel', [200])
+        self.assertEqual(history.recent('guild', channels[1], 5), set())
+        self.assertEqual(history.recent('guild', channels[0], 5), {0, 100})
+        self.assertEqual(history.recent('guild', 'new channel', 5), {200})
+        for i, channel in enumerate(channels[2:], 2):
+            self.assertEqual(history.recent('guild', channel, 5), {i})
+
+    def test_many_channels_stay_bounded(self):
+        history = ra_api.SharedPullHistory(max_channels=16, max_games=5)
+        for i in range(100):
+            history.add('guild', i, [i])
+        remembered = [i for i in range(100) if history.recent('guild', i, 5)]
+        self.assertLessEqual(len(remembered), 16)
+        self.assertIn(99, remembered)
+
+
+class RandomGamesTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        trophytroopa_bench.make_catalog(cls.tmp_dir, 2000)
+        cls.ra = trophytroopa_bench.make_ra_api(cls.tmp_dir, 'http://127.0.0.1:1/')
+        with contextlib.redirect_stdout(io.StringIO()):
+            cls.game_ids = [game.id for game in cls.ra._load_db().all_nonempty_games]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def setUp(self):
+        random.seed(1)
+
+    def test_games_are_unique(self):
+        for weighting in ra_api.RetroAchievementsApi.WEIGHTINGS:
+            games = self.ra.get_random_games(50, weighting=weighting)
+            self.assertEqual(len({game.id for game in games}), 50, weighting)
+
+    def test_excluded_games_are_avoided(self):
+        exclude = set(self.game_ids[::2])
+        for weighting in ra_api.RetroAchievementsApi.WEIGHTINGS:
+            games = self.ra.get_random_games(20, weighting=weighting, exclude=exclude)
+            self.assertEqual(len(games), 20)
+            self.assertFalse({game.id for game in games} & exclude, weighting)
+
+    def test_excluded_games_are_allowed_if_too_few_others(self):
+        exclude = set(self.game_ids[2:])
+        for weighting in ra_api.RetroAchievementsApi.WEIGHTINGS:
+            games = self.ra.get_random_games(5, weighting=weighting, exclude=exclude)
+            self.assertEqual(len({game.id for game in games}), 5, weighting)
+
+    def test_too_few_games(self):
+        with self.assertRaises(Exception):
+            self.ra.get_random_games(len(self.game_ids) + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
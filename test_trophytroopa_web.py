@@ -0,0 +1,91 @@
+"""Tests for the deferred discord responses of trophytroopa_web, against a local stand-in for the APIs.
+Run from the repository directory: python -m pytest test_trophytroopa_web.py"""
+
+import io
+import json
+import shutil
+import tempfile
+import threading
+import contextlib
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from nacl.signing import SigningKey
+import trophytroopa_discord
+import trophytroopa_web as web
+import trophytroopa_bench
+
+_APP_ID = '1234'
+_TOKEN = 'interaction-token'
+
+
+class _StandIn(BaseHTTPRequestHandler):
+    """Answers game detail requests and records the discord webhook calls."""
+
+    protocol_version = 'HTTP/1.1'
+    calls = None
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        data = json.loads(self.rfile.read(length)) if length else None
+        if '/webhooks/' in self.path:
+            self.calls.append((self.command, self.path, data))
+            reply = {'id': '1'}
+        else:
+            reply = {'Developer': 'Dev', 'Publisher': 'Pub', 'Genre': 'Action', 'Released': '1994',
+                     'ImageIngame': '/Images/ingame.png'}
+        body = json.dumps(reply).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PATCH = _handle
+
+
+class DeferredResponseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        trophytroopa_bench.make_catalog(self.tmp_dir, 2000)
+        self.calls = []
+        handler = type('StandIn', (_StandIn,), {'calls': self.calls})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{self.server.server_address[1]}/'
+        self.saved = (web._RA, web._DISCORD)
+        web._RA = trophytroopa_bench.make_ra_api(self.tmp_dir, url)
+        web._DISCORD = trophytroopa_discord.DiscordApi(_APP_ID, SigningKey.generate().verify_key.encode().hex(),
+                                                       'bot-token', api_url=url + 'api/')
+        with contextlib.redirect_stdout(io.StringIO()):
+            web._RA._load_db()
+
+    def tearDown(self):
+        web._RA, web._DISCORD = self.saved
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_large_pull_is_split_into_followups(self):
+        web.send_deferred_response(_TOKEN, {'name': 'trophygames', 'options': [{'name': 'count', 'value': 23}]})
+        self.assertEqual([(method, path) for method, path, _ in self.calls], [
+            ('PATCH', f'/api/webhooks/{_APP_ID}/{_TOKEN}/messages/@original'),
+            ('POST', f'/api/webhooks/{_APP_ID}/{_TOKEN}'),
+            ('POST', f'/api/webhooks/{_APP_ID}/{_TOKEN}'),
+        ])
+        self.assertEqual([len(data['embeds']) for _, _, data in self.calls], [10, 10, 3])
+        self.assertIn('Pulled 23 random games', self.calls[0][2]['content'])
+
+    def test_small_pull_only_edits_original(self):
+        web.send_deferred_response(_TOKEN, {'name': 'trophygames', 'options': [{'name': 'count', 'value': 3}]})
+        self.assertEqual(len(self.calls), 1)
+        method, path, data = self.calls[0]
+        self.assertEqual((method, path), ('PATCH', f'/api/webhooks/{_APP_ID}/{_TOKEN}/messages/@original'))
+        self.assertEqual(len(data['embeds']), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
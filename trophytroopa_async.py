@@ -0,0 +1,250 @@
+"""Asyncio serving mode for TrophyTroopa, serves the same routes as trophytroopa_web.
+
+Upstream requests, rendering and signature checks run on a thread pool, so the event loop
+only handles connections and slow pulls never block other requests like discord PINGs.
+Run this module directly for a small built-in HTTP server, or serve the ASGI `app`
+with any ASGI server, e.g. `uvicorn trophytroopa_async:app`."""
+
+import os
+import sys
+import json
+import asyncio
+import http
+import traceback
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import bottle
+import trophytroopa_web as web
+import metrics
+
+# most of the time the workers are only waiting for upstream requests, so there can be many
+_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.environ.get('ASYNC_WORKERS', 256)))
+_MAX_BODY_SIZE = 1024 * 1024
+
+# path -> function of trophytroopa_web, for the simple GET routes
+_PAGES = {
+    '/trophytroopa/': web.index,
+    '/trophytroopa/tos': web.tos,
+    '/trophytroopa/privacy': web.privacy,
+    '/trophytroopa/random': web.random_game_pull,
+    '/trophytroopa/any': web.any_game_pull,
+    '/trophytroopa/stats': web.stats,
+    '/trophytroopa/metrics': web.metrics_page,
+}
+_API_PREFIX = '/trophytroopa/api/'
+_BULK_PATH = '/trophytroopa/bulk'
+
+
+async def _run(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_EXECUTOR, metrics.call_request,
+                                                            func.__name__, func, *args)
+
+
+def _make_response(result) -> tuple:
+    """Turn the return value of a route into status, headers and body, like bottle does."""
+    if isinstance(result, dict):
+        return 200, [('Content-Type', 'application/json')], json.dumps(result).encode()
+    return 200, [('Content-Type', 'text/html; charset=UTF-8')], str(result).encode()
+
+
+def _make_bottle_response(ex: bottle.HTTPResponse) -> tuple:
+    headers = [(k, v) for k, v in ex.headerlist if k.lower() != 'content-length']
+    body = ex.body if isinstance(ex.body, bytes) else str(ex.body or '').encode()
+    return ex.status_code, headers, body
+
+
+async def _interaction(headers: dict, body: bytes) -> tuple:
+    # the check needs the discord api, which may still be loading, so keep it off the event loop
+    interaction = await _run(web.verify_interaction, body, headers.get('x-signature-ed25519'),
+                             headers.get('x-signature-timestamp'))
+    if interaction.get('type') == 1:
+        # answer PINGs right away, they are used for health checks
+        return web._PONG
+    if web._VERBOSE:
+        print('discord request:', interaction)
+    return await _run(web.handle_interaction, interaction)
+
+
+async def _dispatch(method: str, path: str, query: str, headers: dict, body: bytes) -> tuple:
+    try:
+        if path in ('/', '/trophytroopa'):
+            # we need trailing slash for relative urls
+            return 303, [('Location', '/trophytroopa/')], b''
+        if method == 'POST' and path == '/trophytroopa/discord_interaction':
+            result = await _interaction(headers, body)
+        elif method in ('GET', 'HEAD') and path in _PAGES:
+            result = await _run(_PAGES[path])
+        elif method in ('GET', 'HEAD') and path == _BULK_PATH:
+            # the body is an iterator of chunks, streamed by app()
+            chunks = await _run(web.bulk_games, dict(urllib.parse.parse_qsl(query)))
+            return 200, [('Content-Type', 'application/x-ndjson')], chunks
+        elif method in ('GET', 'HEAD') and path.startswith(_API_PREFIX):
+            cmd = {
+                'name': path[len(_API_PREFIX):],
+                'options': [{'name': k, 'value': v} for (k, v) in urllib.parse.parse_qsl(query)]
+            }
+            result = await _run(web.discord_cmd, cmd)
+        else:
+            bottle.abort(404, 'not found')
+    except bottle.HTTPResponse as ex:
+        # invalid input is answered by the routes with abort(), other errors are server errors
+        return _make_bottle_response(ex)
+    if isinstance(result, bottle.HTTPResponse):
+        return _make_bottle_response(result)
+    return _make_response(result)
+
+
+async def app(scope, receive, send):
+    """ASGI entry point."""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # load the game lists before the server accepts requests
+                await asyncio.get_running_loop().run_in_executor(_EXECUTOR, web.load_apis)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+    status, resp_headers, resp_body = await _dispatch(scope['method'], scope['path'],
+                                                      scope['query_string'].decode('latin-1'),
+                                                      headers, body)
+    if isinstance(resp_body, bytes):
+        resp_headers = resp_headers + [('Content-Length', str(len(resp_body)))]
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(k.encode('latin-1'), v.encode('latin-1')) for k, v in resp_headers],
+    })
+    if isinstance(resp_body, bytes) or scope['method'] == 'HEAD':
+        await send({'type': 'http.response.body', 'body': b'' if scope['method'] == 'HEAD' else resp_body})
+        return
+    # streamed response, the chunks are created on the worker threads
+    loop = asyncio.get_running_loop()
+    while True:
+        chunk = await loop.run_in_executor(_EXECUTOR, next, resp_body, None)
+        if chunk is None:
+            break
+        await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def _write_head(writer: asyncio.StreamWriter, status: int, headers: list, chunked: bool):
+    lines = [f'HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n'.encode('latin-1')]
+    lines.extend(k + b': ' + v + b'\r\n' for k, v in headers)
+    if chunked:
+        lines.append(b'Transfer-Encoding: chunked\r\n')
+    lines.append(b'Connection: close\r\n\r\n')
+    writer.writelines(lines)
+
+
+async def _read_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> tuple:
+    """Read a request and return its ASGI scope and body, raises ValueError for malformed requests."""
+    request_line = (await reader.readline()).decode('latin-1')
+    method, target, _ = request_line.split(' ', 2)
+    headers = []
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers.append((name.strip().lower().encode('latin-1'), value.strip().encode('latin-1')))
+    length = int(dict(headers).get(b'content-length', b'0'))
+    if length > _MAX_BODY_SIZE:
+        raise ValueError('request body too large')
+    body = await reader.readexactly(length) if length else b''
+    path, _, query = target.partition('?')
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method.upper(),
+        'scheme': 'http',
+        'path': urllib.parse.unquote(path),
+        'raw_path': path.encode('latin-1'),
+        'query_string': query.encode('latin-1'),
+        'headers': headers,
+        'client': writer.get_extra_info('peername'),
+    }
+    return scope, body
+
+
+async def _handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Minimal HTTP/1.1 server for the ASGI app, one request per connection.
+       Responses without a Content-Length are sent chunked as the app produces them."""
+    try:
+        scope, body = await _read_request(reader, writer)
+    except (ValueError, asyncio.IncompleteReadError):
+        _write_head(writer, 400, [(b'Content-Length', b'11')], False)
+        writer.write(b'bad request')
+        scope = None
+    except ConnectionError:
+        scope = None
+    response = {'started': False, 'chunked': False}
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['started'] = True
+            response['chunked'] = not any(k.lower() == b'content-length' for k, _ in message['headers'])
+            _write_head(writer, message['status'], message['headers'], response['chunked'])
+            return
+        if scope['method'] == 'HEAD':
+            return
+        data = message.get('body', b'')
+        if not response['chunked']:
+            writer.write(data)
+        elif data:
+            writer.writelines((b'%x\r\n' % len(data), data, b'\r\n'))
+        if response['chunked'] and not message.get('more_body', False):
+            writer.write(b'0\r\n\r\n')
+        # don't produce the next chunk before a slow client has received this one
+        await writer.drain()
+    try:
+        if scope:
+            await app(scope, receive, send)
+    except ConnectionError:
+        pass
+    except Exception:
+        traceback.print_exc()
+        # once the head is sent, closing without the last chunk tells the client the response is incomplete
+        if not response['started']:
+            _write_head(writer, 500, [(b'Content-Length', b'21')], False)
+            writer.write(b'internal server error')
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host=None, port=None, sock=None):
+    """Run the built-in HTTP server until cancelled, on the given address or an already bound socket."""
+    if sock:
+        server = await asyncio.start_server(_handle_connection, sock=sock)
+    else:
+        server = await asyncio.start_server(_handle_connection, host, port, backlog=1024)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    """main entry point if script is called directly."""
+    host = sys.argv[1] if len(sys.argv) > 1 else 'localhost'
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080
+    # load the game lists before accepting requests
+    web.load_apis()
+    asyncio.run(serve(host, port))
+
+if __name__ == '__main__':
+    main()
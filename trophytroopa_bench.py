@@ -0,0 +1,273 @@
+"""Benchmarks for the hot paths of TrophyTroopa, to catch regressions before the catalog grows.
+
+Generates a synthetic game catalog and runs a local stand-in for the RetroAchievements,
+Flashpoint and Discord APIs, so no credentials or network access are needed.
+Run it from the repository directory, it needs system_aliases.json and mature_games.json:
+    python trophytroopa_bench.py [game count] [concurrency] [seconds per benchmark] [upstream latency]"""
+
+import os
+import sys
+import io
+import json
+import time
+import random
+import shutil
+import asyncio
+import tempfile
+import threading
+import contextlib
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from nacl.signing import SigningKey
+import ra_api
+import flashpoint_db_api
+import trophytroopa_discord
+import trophytroopa_web as web
+import trophytroopa_async
+
+_WORDS = ['Super', 'Mega', 'Dragon', 'Quest', 'Kart', 'Star', 'Fighter', 'Legend', 'World', 'Racing',
+          'Puzzle', 'Island', 'Castle', 'Ninja', 'Soccer', 'Tennis', 'Adventure', 'Hero', 'Space', 'Zero']
+_HACK_STR = ra_api.RetroAchievementsApi._HACK_STR
+_APP_ID = '1234'
+
+
+def make_catalog(cache_dir: str, game_count: int, system_count=100, seed=1):
+    """Write systems.json and the game lists of a synthetic catalog into an RA cache directory.
+       IDs from 100 are used by RA for non-game systems, so the last system is the "Hubs" one."""
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(cache_dir, 'gamelist'), exist_ok=True)
+    systems = [{'ID': i, 'Name': f'{rng.choice(_WORDS)} System {i}', 'IconURL': '', 'Active': True,
+                'IsGameSystem': True} for i in range(1, system_count)]
+    systems.append({'ID': 100, 'Name': 'Hubs', 'IconURL': '', 'Active': True, 'IsGameSystem': False})
+    game_id = 1
+    for system in systems[:-1]:
+        games = []
+        for _ in range(game_count // (system_count - 1)):
+            title = f'{rng.choice(_WORDS)} {rng.choice(_WORDS)} {game_id}'
+            if rng.random() < 0.1:
+                title = f'{_HACK_STR} {title}'
+            games.append({'Title': title, 'ID': game_id, 'ConsoleID': system['ID'],
+                          'ConsoleName': system['Name'], 'ImageIcon': f'/Images/{game_id:06}.png',
+                          'NumAchievements': rng.choice([0, 0, 12, 25, 40, 80])})
+            game_id += 1
+        with open(os.path.join(cache_dir, 'gamelist', f'{system["ID"]}.json'), 'w') as f:
+            json.dump(games, f)
+    with open(os.path.join(cache_dir, 'gamelist', '100.json'), 'w') as f:
+        json.dump([], f)
+    # written last, its mtime is the timestamp of the catalog
+    with open(os.path.join(cache_dir, 'systems.json'), 'w') as f:
+        json.dump(systems, f)
+    return systems
+
+
+class _FakeUpstream(BaseHTTPRequestHandler):
+    """Answers the RA, Flashpoint and Discord requests that TrophyTroopa makes."""
+
+    protocol_version = 'HTTP/1.1'
+    # send headers and body in one packet, separate small writes stall on delayed acks
+    wbufsize = -1
+    cache_dir = None
+    latency = 0.0
+    flashpoint_games = [{'id': f'{i:08x}-0000-0000-0000-000000000000', 'title': f'Flash Game {i}',
+                         'platform': 'Flash'} for i in range(5000)]
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self, name: str):
+        with open(os.path.join(self.cache_dir, name), 'rb') as f:
+            return json.load(f)
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        time.sleep(self.latency)
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if url.path.endswith('API_GetConsoleIDs.php'):
+            return self._reply(self._read_json('systems.json'))
+        if url.path.endswith('API_GetGameList.php'):
+            return self._reply(self._read_json(f'gamelist/{query["i"]}.json'))
+        if url.path.endswith('API_GetGame.php'):
+            game_id = query['i']
+            return self._reply({'Title': f'Game {game_id}', 'Developer': 'Dev', 'Publisher': 'Pub',
+                                'Genre': 'Action', 'Released': '1994-01-01',
+                                'ImageIngame': f'/Images/{int(game_id):06}_ingame.png'})
+        if url.path.endswith('/search'):
+            offset = int(query.get('offset', 0))
+            limit = int(query.get('limit', len(self.flashpoint_games)))
+            return self._reply(self.flashpoint_games[offset:offset + limit])
+        if '/webhooks/' in url.path:
+            return self._reply({'id': '1', 'channel_id': '1'})
+        return self._reply({'error': 'not found'}, 404)
+
+    do_GET = do_POST = do_PATCH = _handle
+
+
+def start_upstream(cache_dir: str, latency=0.0):
+    """Run the fake upstream server in a background thread, returns the server and its base url."""
+    handler = type('FakeUpstream', (_FakeUpstream,), {'cache_dir': cache_dir, 'latency': latency})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/'
+
+
+def make_ra_api(cache_dir: str, upstream_url: str):
+    """Create an RA api for the synthetic catalog, with the detail rate limit lifted,
+       so that the benchmarks measure TrophyTroopa and not the limiter."""
+    ra = ra_api.RetroAchievementsApi('bench', 'key', cache_dir, detail_rate=1e6, detail_burst=1000,
+                                     detail_workers=16)
+    ra._API_URL = upstream_url + 'API/'
+    return ra
+
+
+def _percentile(sorted_values: list, q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def measure(name: str, func, seconds=2.0, concurrency=1, max_calls=None):
+    """Call func repeatedly from the given number of threads, and print throughput and latencies."""
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+    def run():
+        own = []
+        while time.perf_counter() < deadline and (max_calls is None or len(own) < max_calls):
+            start = time.perf_counter()
+            func()
+            own.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(own)
+    start = time.perf_counter()
+    # the hot paths print a line on every reload, keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for future in [pool.submit(run) for _ in range(concurrency)]:
+                future.result()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f'{name:<40} {len(latencies) / elapsed:>10.1f}/s {_percentile(latencies, 0.5) * 1000:>9.3f}ms '
+          f'{_percentile(latencies, 0.99) * 1000:>9.3f}ms {len(latencies):>8}')
+
+
+def _serve_async(port_ready: list, ready: threading.Event):
+    async def serve():
+        server = await asyncio.start_server(trophytroopa_async._handle_connection, '127.0.0.1', 0, backlog=1024)
+        port_ready.append(server.sockets[0].getsockname()[1])
+        ready.set()
+        async with server:
+            await server.serve_forever()
+    asyncio.run(serve())
+
+
+def _make_interaction_request(signing_key: SigningKey, interaction: dict):
+    body = json.dumps(interaction).encode()
+    timestamp = str(int(time.time()))
+    signature = signing_key.sign(timestamp.encode() + body).signature.hex()
+    return body, {'Content-Type': 'application/json', 'X-Signature-Ed25519': signature,
+                  'X-Signature-Timestamp': timestamp}
+
+
+def _post_interaction(port: int, body: bytes, headers: dict):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        conn.request('POST', '/trophytroopa/discord_interaction', body=body, headers=headers)
+        resp = conn.getresponse()
+        data = resp.read()
+        if resp.status != 200:
+            raise Exception(f'interaction failed with {resp.status}: {data[:200]}')
+        return json.loads(data)
+    finally:
+        conn.close()
+
+
+def run(game_count=100000, concurrency=16, seconds=2.0, latency=0.0):
+    """Generate the catalog, start the fake upstream and run all benchmarks."""
+    tmp_dir = tempfile.mkdtemp(prefix='trophytroopa_bench_')
+    try:
+        cache_dir = os.path.join(tmp_dir, 'db')
+        start = time.perf_counter()
+        systems = make_catalog(cache_dir, game_count)
+        print(f'generated {game_count} games in {len(systems)} systems in {time.perf_counter() - start:.1f}s')
+        server, upstream_url = start_upstream(cache_dir, latency)
+        print(f'{"benchmark":<40} {"throughput":>12} {"p50":>11} {"p99":>11} {"calls":>8}')
+
+        measure('_load_db (parse json, build catalog)',
+                lambda: make_ra_api(cache_dir, upstream_url)._load_db(), seconds, max_calls=1)
+        measure('_load_db (map existing catalog)',
+                lambda: make_ra_api(cache_dir, upstream_url)._load_db(), seconds)
+
+        ra = make_ra_api(cache_dir, upstream_url)
+        with contextlib.redirect_stdout(io.StringIO()):
+            ra._load_db()
+        some_systems = [s['ID'] for s in systems[:3]]
+        measure('get_random_games(10, no hacks)',
+                lambda: ra.get_random_games(10, allow_hacks=False), seconds)
+        measure('get_random_games(10, 3 systems, no hacks)',
+                lambda: ra.get_random_games(10, allow_hacks=False, systems=some_systems), seconds)
+        for weighting in ('achievements', 'system'):
+            measure(f'get_random_games(10, {weighting} weighting)',
+                    lambda: ra.get_random_games(10, allow_hacks=False, weighting=weighting), seconds)
+        recent = {g.id for g in ra.get_random_games(100, allow_hacks=False)}
+        measure('get_random_games(10, 100 excluded)',
+                lambda: ra.get_random_games(10, allow_hacks=False, exclude=recent), seconds)
+        names = [s['Name'] for s in systems]
+        queries = [name[i:i + 5] for name in names for i in range(0, len(name) - 5, 3)] + ['nonexistent']
+        measure('match_system',
+                lambda: ra.match_system(random.choice(queries)), seconds)
+        measure('stats()', ra.stats, seconds)
+        measure('get_game_details (cached)',
+                lambda: ra.get_game_details(1, ignore_error=True), seconds)
+
+        # the web app with the fake apis, answering signed interactions
+        signing_key = SigningKey.generate()
+        web._RA = ra
+        web._DISCORD = trophytroopa_discord.DiscordApi(_APP_ID, signing_key.verify_key.encode().hex(), 'token',
+                                                      api_url=upstream_url + 'api/v10/')
+        flashpoint = flashpoint_db_api.FlashpointDbApi('bench', 'developer=bench', os.path.join(tmp_dir, 'fp'))
+        flashpoint._BASE_URL = upstream_url
+        web._FLASHPOINT = {flashpoint.name: flashpoint}
+        measure('bulk_games(count=5000, details)',
+                lambda: sum(len(c) for c in web.bulk_games({'count': 5000, 'empty': '1', 'details': '1'})), seconds)
+        measure('flashpoint get_random_game (build index)', flashpoint.get_random_game, seconds, max_calls=1)
+        measure('flashpoint get_random_game', flashpoint.get_random_game, seconds)
+
+        port = []
+        ready = threading.Event()
+        threading.Thread(target=_serve_async, args=(port, ready), daemon=True).start()
+        ready.wait()
+        ping = _make_interaction_request(signing_key, {'type': 1})
+        pull = {'type': 2, 'token': 'token', 'data': {'name': 'trophygames', 'options': [
+            {'name': 'count', 'value': 3}, {'name': 'hacks', 'value': False}]}}
+        def post_pull():
+            # signed for every request, like discord does
+            _post_interaction(port[0], *_make_interaction_request(signing_key, pull))
+        measure('/discord_interaction PING', lambda: _post_interaction(port[0], *ping), seconds, concurrency)
+        measure('/discord_interaction /trophygames count=3', post_pull, seconds, concurrency)
+        server.shutdown()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def main():
+    """main entry point if script is called directly."""
+    game_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 2.0
+    latency = float(sys.argv[4]) if len(sys.argv) > 4 else 0.0
+    run(game_count, concurrency, seconds, latency)
+
+if __name__ == '__main__':
+    main()
@@ -2,48 +2,62 @@
 
 import sys
 import json
-import urllib.request
+import time
+import httputil
+import flashpoint_db_api
 from nacl.signing import VerifyKey
 from nacl.exceptions import BadSignatureError
+import nacl.bindings
 
 _DISCORD_API_URL = 'https://discord.com/api/v10/'
+# requests with older (or newer) timestamps are rejected, so that captured requests can't be replayed later
+_MAX_TIMESTAMP_AGE = 300
+_SIGNATURE_HEX_LENGTH = 128
 
 class DiscordApi:
     """Some simple functions to interact with the discord bot API, to register commands."""
 
-    def __init__(self, app_id, public_key, bot_token):
+    def __init__(self, app_id, public_key, bot_token, api_url=_DISCORD_API_URL):
         self.app_id = app_id
         self.verify_key = VerifyKey(bytes.fromhex(public_key))
+        # raw key bytes for crypto_sign_open, checked once by VerifyKey
+        self._verify_key_bytes = bytes(self.verify_key)
         self.bot_token = bot_token
+        self.api_url = api_url
 
     def verify_signature(self, data: bytes, signature: str, timestamp: str) -> bool:
-        """Verify signatures sent by discord."""
+        """Verify signatures sent by discord, rejects malformed and outdated requests before checking."""
         try:
-            self.verify_key.verify(timestamp.encode() + data, bytes.fromhex(signature))
+            if abs(time.time() - int(timestamp)) > _MAX_TIMESTAMP_AGE or len(signature) != _SIGNATURE_HEX_LENGTH:
+                return False
+            # the signed message is the timestamp followed by the body,
+            # build signature + message in one go instead of letting VerifyKey concatenate again
+            nacl.bindings.crypto_sign_open(b''.join((bytes.fromhex(signature), timestamp.encode(), data)),
+                                           self._verify_key_bytes)
             return True
-        except BadSignatureError:
+        except (BadSignatureError, ValueError):
             return False
 
-    def _send_request(self, url, data=None):
+    def _send_request(self, url, data=None, method=None):
         if data:
-            method = 'POST'
+            method = method or 'POST'
             body = json.dumps(data).encode()
         else:
-            method = None
             body = None
-        req = urllib.request.Request(url, data=body, method=method)
-        req.add_header('Authorization', 'Bot ' + self.bot_token)
-        req.add_header('Accept', 'application/json')
-        req.add_header('User-Agent', 'TrophyTroopa')
+        headers = {
+            'Authorization': 'Bot ' + self.bot_token,
+            'Accept': 'application/json',
+        }
         if body:
-            req.add_header('Content-Type', 'application/json')
-        with urllib.request.urlopen(req) as resp:
-            return json.loads(resp.read())
+            headers['Content-Type'] = 'application/json'
+        resp = httputil.client.request(url, method=method or 'GET', body=body, headers=headers)
+        return json.loads(resp.body)
 
-    def register_commands(self, guild=None):
-        """Register the bot commands for the given guild, or globally if no guild specified."""
+    def register_commands(self, guild=None, max_count=10):
+        """Register the bot commands for the given guild, or globally if no guild specified.
+           Only raise max_count above 10 if the web server sends deferred responses."""
         guild_part = f'/guilds/{guild}' if guild else ''
-        url = _DISCORD_API_URL + f'applications/{self.app_id}{guild_part}/commands'
+        url = self.api_url + f'applications/{self.app_id}{guild_part}/commands'
 
         cmdlist = [{
             'name': 'trophygames',
@@ -52,11 +66,13 @@ class DiscordApi:
             'options': [
                 {
                     'name': 'count',
-                    'description': 'How many games to return (1-10, default: 1)',
+                    'description': f'How many games to return (1-{max_count}, default: 1)',
                     'type': 4, # INTEGER
                     'required': False,
                     'min_value': 1,
-                    'max_value': 10 # RetroAchievements quickly rate-limits after ~8 requests
+                    # RetroAchievements quickly rate-limits after ~8 requests,
+                    # so more are only feasible without the 3 second response deadline
+                    'max_value': max_count
                 },
                 {
                     'name': 'empty',
@@ -75,13 +91,43 @@ class DiscordApi:
                     'description': 'Limit to one or more systems, use name substrings joined by comma ","',
                     'type': 3, # STRING
                     'required': False
+                },
+                {
+                    'name': 'weighting',
+                    'description': 'Which games are more likely (default: all the same)',
+                    'type': 3, # STRING
+                    'required': False,
+                    'choices': [
+                        {'name': 'All games the same', 'value': 'uniform'},
+                        {'name': 'Games with more achievements', 'value': 'achievements'},
+                        {'name': 'All systems the same', 'value': 'system'}
+                    ]
+                },
+                {
+                    'name': 'norepeat',
+                    'description': 'Avoid games from the last N pulls in this channel',
+                    'type': 4, # INTEGER
+                    'required': False,
+                    'min_value': 0,
+                    'max_value': 100
                 }
             ]
         },
         {
-            'name': 'jollymania',
+            'name': 'flashpoint',
             'type': 1, # CHAT_INPUT
-            'description': 'Get a random Games2Jolly game from the Flashpoint database',
+            'description': 'Get a random game from a collection of the Flashpoint database',
+            'options': [
+                {
+                    'name': 'collection',
+                    'description': 'Which collection to pull from',
+                    'type': 3, # STRING
+                    'required': False,
+                    # discord allows at most 25 choices
+                    'choices': [{'name': api.description, 'value': name}
+                                for name, api in list(flashpoint_db_api.get_collections().items())[:25]]
+                }
+            ]
         },
         {
             'name': 'random',
@@ -108,20 +154,32 @@ class DiscordApi:
 
     def list_guilds(self):
         """Request a list of guilds in which the bot is a member."""
-        return self._send_request(_DISCORD_API_URL + 'users/@me/guilds')
+        return self._send_request(self.api_url + 'users/@me/guilds')
+
+    def edit_interaction_response(self, interaction_token: str, data: dict):
+        """Replace the original (e.g. deferred) response message of an interaction."""
+        url = self.api_url + f'webhooks/{self.app_id}/{interaction_token}/messages/@original'
+        return self._send_request(url, data=data, method='PATCH')
+
+    def send_followup_message(self, interaction_token: str, data: dict):
+        """Send an additional message in response to an interaction."""
+        url = self.api_url + f'webhooks/{self.app_id}/{interaction_token}'
+        return self._send_request(url, data=data)
 
 def get_api():
     """Create a new DiscordApi instance with configuration from discord_config.json."""
     with open('discord_config.json', 'rb') as f:
         cfg = json.load(f)
-    return DiscordApi(cfg['app_id'], cfg['pub_key'], cfg['bot_token'])
+    return DiscordApi(cfg['app_id'], cfg['pub_key'], cfg['bot_token'],
+                      api_url=cfg.get('api_url', _DISCORD_API_URL))
 
 def main():
     """main entry point if script is called directly."""
     cmd = sys.argv[1] if len(sys.argv) > 1 else None
     if cmd == 'register':
-        guild_id = int(sys.argv[2]) if len(sys.argv) > 2 else None
-        print(get_api().register_commands(guild_id), sep='\n')
+        guild_id = int(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2] != 'global' else None
+        max_count = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+        print(get_api().register_commands(guild_id, max_count), sep='\n')
     elif cmd == 'guilds':
         print(*get_api().list_guilds(), sep='\n')
     else:
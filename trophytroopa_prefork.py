@@ -0,0 +1,117 @@
+"""Pre-fork launcher for TrophyTroopa, runs several worker processes of trophytroopa_async on one port.
+
+The game list is loaded once in the parent before forking, so all workers share its memory.
+The parent watches for database updates and tells the workers with SIGHUP to reload.
+Only works on systems with os.fork(), i.e. not on Windows."""
+
+import os
+import sys
+import gc
+import time
+import signal
+import socket
+import asyncio
+import ra_api
+import trophytroopa_web as web
+import trophytroopa_async
+
+
+def _run_worker(sock: socket.socket, worker_count: int):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    ra = web._get_ra_api()
+    ra.after_fork(worker_count)
+    for api in web._get_flashpoint_apis().values():
+        api.after_fork()
+    web.after_fork()
+    # the parent checks for updates, so there's no need to check on every request
+    ra.reload_interval = float('inf')
+    # a worker started while the parent was reloading got the old snapshot, and won't be notified
+    ra.check_for_update()
+    async def serve():
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, ra.check_for_update)
+        await trophytroopa_async.serve(sock=sock)
+    try:
+        asyncio.run(serve())
+    finally:
+        os._exit(0)
+
+
+def _start_worker(sock: socket.socket, worker_count: int) -> int:
+    pid = os.fork()
+    if pid == 0:
+        _run_worker(sock, worker_count)
+    return pid
+
+
+def run(host: str, port: int, worker_count: int, check_interval=10.0):
+    """Load the game lists, then start the workers and keep them running."""
+    web.load_apis()
+    ra = web._get_ra_api()
+    # excluding recent pulls of a channel only works if all workers see them
+    web._PULL_HISTORY = ra_api.SharedPullHistory()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.setblocking(False)
+
+    # move everything loaded so far out of the gc's reach, so that collections in the workers
+    # don't write to those objects and copy the shared pages
+    gc.disable()
+    gc.collect()
+    gc.freeze()
+    # the frozen objects are left alone, but replaced snapshots have to be collected,
+    # their catalog and game lists reference each other
+    gc.enable()
+    frozen_generation = ra.db.generation
+
+    workers = set(_start_worker(sock, worker_count) for _ in range(worker_count))
+    running = True
+    def stop(signum, frame):
+        nonlocal running
+        running = False
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    last_check = time.monotonic()
+    while running:
+        time.sleep(0.5)
+        # restart workers that died
+        while workers:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                break
+            workers.discard(pid)
+            if running:
+                print('worker', pid, 'exited, restarting')
+                workers.add(_start_worker(sock, worker_count))
+        if time.monotonic() - last_check >= check_interval:
+            last_check = time.monotonic()
+            if ra.check_for_update():
+                print('db changed, notifying workers')
+                for pid in workers:
+                    os.kill(pid, signal.SIGHUP)
+        if ra.db.generation != frozen_generation:
+            # the frozen snapshot was replaced by a finished reload, free it and its mapped catalog,
+            # and freeze the new one for the workers that are started from now on
+            frozen_generation = ra.db.generation
+            gc.unfreeze()
+            gc.collect()
+            gc.freeze()
+
+    for pid in workers:
+        os.kill(pid, signal.SIGTERM)
+    for pid in workers:
+        os.waitpid(pid, 0)
+
+
+def main():
+    """main entry point if script is called directly."""
+    host = sys.argv[1] if len(sys.argv) > 1 else 'localhost'
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080
+    worker_count = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+    run(host, port, worker_count)
+
+if __name__ == '__main__':
+    main()
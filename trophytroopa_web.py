@@ -1,19 +1,38 @@
 """Web API for TrophyTroopa, handles browsers, discord embeds and discord bot interactions."""
 
 import os
-import time
+import json
 import random
-from bottle import route, post, request, template, redirect, abort, run
+import functools
+import queue
+import threading
+import traceback
+from bottle import route, post, request, response, install, SimpleTemplate, HTTPResponse, redirect, abort, run
 import trophytroopa_discord
 import ra_api
+import game_catalog
 import flashpoint_db_api
+import httputil
+import metrics
 
 # use the two primary RetroAchievements colors to mark the embeds
 _DISCORD_EMBED_COLORS = [0x1066dd, 0xcc9a00]
-_JOLLY_EMBED_COLOR = 0xf9cf00
+_FLASHPOINT_EMBED_COLOR = 0xf9cf00
 # unicode codepoints for cross and checkmark, representing false/true
 _BOOL_EMOTE = ['\u274C', '\u2705']
 _CONCERNED_EMOTE = '\U0001F622'
+# discord expects an interaction response within 3 seconds,
+# games without details by then are sent without them
+_DETAILS_TIMEOUT = 2.0
+# deferred responses can be edited for 15 minutes, but users will not wait that long
+_DEFERRED_DETAILS_TIMEOUT = 30.0
+# discord allows at most 10 embeds per message, larger pulls are split into follow-up messages
+_DISCORD_MAX_EMBEDS = 10
+# limits of the bulk route, the games are sent in batches of lines
+_BULK_MAX_COUNT = 100000
+_BULK_BATCH_SIZE = 256
+# how many recent pulls of a channel are avoided if the command doesn't say otherwise
+_DEFAULT_NO_REPEAT = int(os.environ.get('NO_REPEAT', 0))
 
 HTML_INDEX_TEMPLATE = """
 <html>
@@ -22,8 +41,8 @@ HTML_INDEX_TEMPLATE = """
   </head>
   <body>
     <h1>TrophyTroopa Random Games Bot</h1>
-    <div>games with achievements: {{len(ra.get_full_gamelist(allow_empty=False))}}</div>
-    <div>total games: {{len(ra.get_full_gamelist(allow_empty=True))}}</div>
+    <div>games with achievements: {{nonempty}}</div>
+    <div>total games: {{total}}</div>
 %if timestamp:
     <div>last updated at: {{timestamp}}</div>
 %end
@@ -51,25 +70,25 @@ HTML_PRIVACY_TEMPLATE = """
 HTML_GAME_TEMPLATE = """
 <html>
   <head>
-    <title>TrophyTroopa Pull: {{game['Title']}}</title>
-    <meta property="og:title" content="{{game['Title']}}" />
-    <meta property="og:description" content="{{game['Title']}} ({{game['ConsoleName']}}), {{game['NumAchievements']}} achievements" />
+    <title>TrophyTroopa Pull: {{game.title}}</title>
+    <meta property="og:title" content="{{game.title}}" />
+    <meta property="og:description" content="{{game.title}} ({{game.console_name}}), {{game.num_achievements}} achievements" />
     <meta property="og:type" content="website" />
-    <meta property="og:url" content="{{ra.make_game_url(game['ID'])}}" />
-    <meta property="og:image" content="{{ra.make_full_url(game['ImageIcon'])}}" />
+    <meta property="og:url" content="{{ra.make_game_url(game.id)}}" />
+    <meta property="og:image" content="{{ra.make_full_url(game.image_icon)}}" />
   </head>
   <body>
-    <img src="{{ra.make_full_url(game['ImageIcon'])}}" />
-    <div>Game: {{game['Title']}}</div>
-    <div>System: {{game['ConsoleName']}}</div>
+    <img src="{{ra.make_full_url(game.image_icon)}}" />
+    <div>Game: {{game.title}}</div>
+    <div>System: {{game.console_name}}</div>
 %if details:
     <div>Developer: {{details['Developer']}}</div>
     <div>Publisher: {{details['Publisher']}}</div>
     <div>Genre: {{details['Genre']}}</div>
     <div>Released: {{details['Released']}}</div>
 %end
-    <div>Achievements: {{game['NumAchievements']}}</div>
-    <a href="{{ra.make_game_url(game['ID'])}}">game page</a>
+    <div>Achievements: {{game.num_achievements}}</div>
+    <a href="{{ra.make_game_url(game.id)}}">game page</a>
     <div><a href="random">go here for a random game with achievements</a></div>
     <div><a href="any">go here for any random game</a></div>
   </body>
@@ -94,36 +113,119 @@ HTML_STATS_TEMPLATE = """
 </html>
 """
 
+# compile the templates once instead of looking them up on every request
+_INDEX_TEMPLATE = SimpleTemplate(HTML_INDEX_TEMPLATE)
+_GAME_TEMPLATE = SimpleTemplate(HTML_GAME_TEMPLATE)
+_STATS_TEMPLATE = SimpleTemplate(HTML_STATS_TEMPLATE)
+_TOS_PAGE = SimpleTemplate(HTML_TOS_TEMPLATE).render()
+_PRIVACY_PAGE = SimpleTemplate(HTML_PRIVACY_TEMPLATE).render()
+
 _RA = None
 _DISCORD = None
-_GAMES2JOLLY = None
+# flashpoint collection name -> FlashpointDbApi
+_FLASHPOINT = None
+# the apis are also used from worker threads, only create them once
+_INIT_LOCK = threading.Lock()
+_FLASHPOINT_LOCK = threading.Lock()
+# rendered pages that only depend on the game db, name -> (db generation, html)
+_PAGE_CACHE = {}
+# recent pulls per discord channel, kept in memory of this process,
+# the prefork launcher replaces it with one that is shared by its workers
+_PULL_HISTORY = ra_api.PullHistory()
 
 
 def _get_ra_api():
     global _RA
-    if not _RA:
-        _RA = ra_api.get_api()
-        # make sure the list is loaded
-        _RA.get_full_gamelist()
+    with _INIT_LOCK:
+        if not _RA:
+            ra = ra_api.get_api()
+            # make sure the list is loaded
+            ra.get_full_gamelist()
+            _RA = ra
     return _RA
 
 
 def _get_discord_api():
     global _DISCORD
-    if not _DISCORD:
-        _DISCORD = trophytroopa_discord.get_api()
+    with _INIT_LOCK:
+        if not _DISCORD:
+            _DISCORD = trophytroopa_discord.get_api()
     return _DISCORD
 
 
-def _get_jolly_api():
-    global _GAMES2JOLLY
-    if not _GAMES2JOLLY:
-        _GAMES2JOLLY = flashpoint_db_api.get_api('games2jolly', 'developer=games2jolly')
-    return _GAMES2JOLLY
+def _get_flashpoint_apis():
+    global _FLASHPOINT
+    # separate lock, so that the collections can load while the other apis are created
+    with _FLASHPOINT_LOCK:
+        if _FLASHPOINT is None:
+            collections = flashpoint_db_api.get_collections()
+            flashpoint_db_api.load_collections(collections)
+            _FLASHPOINT = collections
+    return _FLASHPOINT
+
+
+def load_apis():
+    """Load the RetroAchievements game list and the Flashpoint collections in parallel,
+       so that the first requests don't have to wait for them."""
+    flashpoint = threading.Thread(target=_get_flashpoint_apis)
+    flashpoint.start()
+    _get_discord_api()
+    _get_ra_api()
+    flashpoint.join()
+
 
+def after_fork():
+    """reset the module state that can't be inherited from the parent process after os.fork()"""
+    global _INIT_LOCK, _FLASHPOINT_LOCK, _DEFERRED_LOCK, _DEFERRED_QUEUE
+    # another thread of the parent may have held the locks while forking
+    _INIT_LOCK = threading.Lock()
+    _FLASHPOINT_LOCK = threading.Lock()
+    _DEFERRED_LOCK = threading.Lock()
+    _PULL_HISTORY.after_fork()
+    # the deferred workers of the parent don't exist in the child, they are started again on demand
+    _DEFERRED_QUEUE = queue.Queue()
+    _DEFERRED_WORKERS.clear()
+
+
+_PONG = {'type': 1}
 
 # flag for printing debug output
 _VERBOSE = "VERBOSE" in os.environ
+# flag for answering slow commands with a deferred response, and sending the result later
+_DEFERRED = "DEFERRED" in os.environ
+_DEFERRED_COMMANDS = {'trophygames', 'flashpoint', 'jollymania'}
+_DEFERRED_WORKER_COUNT = 4
+_DEFERRED_QUEUE = queue.Queue()
+_DEFERRED_WORKERS = []
+_DEFERRED_LOCK = threading.Lock()
+
+
+def _start_deferred_workers():
+    with _DEFERRED_LOCK:
+        if not _DEFERRED_WORKERS:
+            for _ in range(_DEFERRED_WORKER_COUNT):
+                worker = threading.Thread(target=_deferred_worker, daemon=True)
+                worker.start()
+                _DEFERRED_WORKERS.append(worker)
+
+
+def _deferred_worker():
+    while True:
+        token, cmd, channel = _DEFERRED_QUEUE.get()
+        try:
+            metrics.call_request('send_deferred_response', send_deferred_response, token, cmd, channel)
+        except Exception:
+            traceback.print_exc()
+
+
+def _metrics_plugin(callback):
+    """bottle plugin that times every route, and profiles a sample of the requests if enabled"""
+    @functools.wraps(callback)
+    def wrapper(*args, **kwargs):
+        return metrics.call_request(callback.__name__, callback, *args, **kwargs)
+    return wrapper
+
+install(_metrics_plugin)
 
 
 @route('/trophytroopa')
@@ -133,21 +235,35 @@ def redirect_to_index():
     return redirect('/trophytroopa/')
 
 
+def _cached_page(name, ra, render):
+    """Return the cached html for the page, or render it again if the game db changed."""
+    generation = ra.get_db_generation()
+    cached = _PAGE_CACHE.get(name)
+    if cached and cached[0] == generation:
+        return cached[1]
+    html = render()
+    _PAGE_CACHE[name] = (generation, html)
+    return html
+
+
 @route('/trophytroopa/')
 def index():
     ra = _get_ra_api()
-    ts = ra.get_update_timestamp()
-    return template(HTML_INDEX_TEMPLATE, ra=ra, timestamp=ts)
+    def render():
+        ts = ra.get_update_timestamp()
+        _, (total, nonempty) = ra.stats()
+        return _INDEX_TEMPLATE.render(total=total, nonempty=nonempty, timestamp=ts)
+    return _cached_page('index', ra, render)
 
 
 @route('/trophytroopa/tos')
 def tos():
-    return template(HTML_TOS_TEMPLATE)
+    return _TOS_PAGE
 
 
 @route('/trophytroopa/privacy')
 def privacy():
-    return template(HTML_PRIVACY_TEMPLATE)
+    return _PRIVACY_PAGE
 
 
 @route('/trophytroopa/random')
@@ -163,30 +279,52 @@ def any_game_pull():
 def show_random_game(allow_empty: bool):
     ra = _get_ra_api()
     game = ra.get_random_games(1, allow_empty=allow_empty)[0]
-    details = ra.get_game_details(game['ID'], ignore_error=True)
-    return template(HTML_GAME_TEMPLATE, ra=ra, game=game, details=details)
+    # like the discord commands, render without details rather than waiting on RA
+    details = ra.get_many_game_details([game.id], _DETAILS_TIMEOUT).get(game.id)
+    return _GAME_TEMPLATE.render(ra=ra, game=game, details=details)
 
 
 @route('/trophytroopa/stats')
 def stats():
     ra = _get_ra_api()
-    table, (total, nonempty) = ra.stats()
-    table = sorted(table.items(), key=lambda row: (row[1][1], row[1][0]), reverse=True)
-    return template(HTML_STATS_TEMPLATE, stats=table, total=total, nonempty=nonempty)
+    def render():
+        table, (total, nonempty) = ra.stats()
+        table = sorted(table.items(), key=lambda row: (row[1][1], row[1][0]), reverse=True)
+        return _STATS_TEMPLATE.render(stats=table, total=total, nonempty=nonempty)
+    return _cached_page('stats', ra, render)
+
+
+@route('/trophytroopa/metrics')
+def metrics_page():
+    """Latency histograms and counters of this process, in the Prometheus text format."""
+    body = metrics.render(httputil.upstream_metrics())
+    return HTTPResponse(body, headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
 
 
 @post('/trophytroopa/discord_interaction')
 def discord_interaction():
+    interaction = discord_verify(request)
+    if interaction.get('type') == 1:
+        # answer PINGs right away, they are used for health checks
+        return _PONG
     if _VERBOSE:
-        print('discord request:', request.json)
-    discord_verify(request)
+        print('discord request:', interaction)
+    return handle_interaction(interaction)
+
 
-    req_type = request.json['type']
+def handle_interaction(interaction: dict):
+    """Process a discord interaction with an already verified signature."""
+    req_type = interaction['type']
     if req_type == 1:  # PING
-        response = {'type': 1}  # PONG
+        response = _PONG
     elif req_type == 2:  # APPLICATION_COMMAND
-        cmd = request.json['data']
-        return discord_cmd(cmd)
+        cmd = interaction['data']
+        channel = (interaction.get('guild_id'), interaction.get('channel_id'))
+        if not _DEFERRED or cmd['name'] not in _DEFERRED_COMMANDS:
+            return discord_cmd(cmd, channel=channel)
+        _start_deferred_workers()
+        _DEFERRED_QUEUE.put((interaction['token'], cmd, channel))
+        response = {'type': 5}  # DEFERRED_CHANNEL_MESSAGE_WITH_SOURCE
     else:
         return abort(400, 'invalid interaction type')
 
@@ -204,25 +342,113 @@ def api_interaction(cmd):
     })
 
 
-def discord_verify(req):
-    """Check the request signature as required by Discord for interactions."""
-    signature = req.headers['X-Signature-Ed25519']
-    timestamp = req.headers['X-Signature-Timestamp']
-    data = req.body.read()
+@route('/trophytroopa/bulk')
+def bulk_pull():
+    """Route for tools that need many random games at once, sends them as newline-delimited json."""
+    chunks = bulk_games(request.query)
+    response.content_type = 'application/x-ndjson'
+    return chunks
+
+
+def _parse_bool(value) -> bool:
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+
+def bulk_games(params):
+    """Pull games for the bulk route, with the options count, systems, empty, hacks and details.
+       Returns an iterator of ndjson chunks, the games are only created while it is consumed.
+       With details=true, details are added if they are already cached, they are never requested."""
+    try:
+        count = int(params.get('count', 100))
+    except ValueError:
+        return abort(400, 'invalid count')
+    if not 0 < count <= _BULK_MAX_COUNT:
+        return abort(400, f'count must be between 1 and {_BULK_MAX_COUNT}')
+    ra = _get_ra_api()
+    systems = []
+    for s in (params.get('systems') or '').split(','):
+        s = s.strip()
+        if not s:
+            continue
+        m = ra.match_system(s)
+        if not m:
+            return abort(400, f'no match for system "{s}"')
+        systems.append(m['ID'])
+    games = ra.iter_random_games(count, allow_empty=_parse_bool(params.get('empty')),
+                                 allow_hacks=_parse_bool(params.get('hacks')), systems=systems)
+    with_details = _parse_bool(params.get('details'))
+    def generate():
+        batch = []
+        for game in games:
+            entry = {
+                'id': game.id,
+                'title': game.title,
+                'console_id': game.console_id,
+                'console_name': game.console_name,
+                'num_achievements': game.num_achievements,
+                'icon': ra.make_full_url(game.image_icon),
+                'url': ra.make_game_url(game.id),
+            }
+            if with_details:
+                entry['details'] = ra.get_cached_game_details(game.id)
+            batch.append(json.dumps(entry))
+            if len(batch) >= _BULK_BATCH_SIZE:
+                yield '\n'.join(batch) + '\n'
+                batch = []
+        if batch:
+            yield '\n'.join(batch) + '\n'
+    return generate()
+
+
+def discord_verify(req) -> dict:
+    """Check the request signature as required by Discord for interactions, and return the parsed body."""
+    return verify_interaction(req.body.read(), req.headers.get('X-Signature-Ed25519'),
+                              req.headers.get('X-Signature-Timestamp'))
+
+
+def verify_interaction(data: bytes, signature: str, timestamp: str) -> dict:
+    """Check the signature of an interaction and parse it, the body is only parsed once it is trusted."""
+    if not signature or not timestamp:
+        abort(401, 'invalid request signature')
+    check_signature(data, signature, timestamp)
+    try:
+        return json.loads(data)
+    except ValueError:
+        return abort(400, 'invalid request')
+
+
+@metrics.timed('signature_check_seconds')
+def check_signature(data: bytes, signature: str, timestamp: str):
+    """Abort with 401 if the discord signature doesn't match the data."""
     discord = _get_discord_api()
     if not discord.verify_signature(data, signature, timestamp):
         abort(401, 'invalid request signature')
 
 
-def discord_cmd(cmd):
-    """Dispatch the discord slash commands."""
+def send_deferred_response(token, cmd, channel=None):
+    """Process a command that was answered with a deferred response, and send the actual result."""
+    response = discord_cmd(cmd, details_timeout=_DEFERRED_DETAILS_TIMEOUT, channel=channel)
+    data = response['data']
+    embeds = data.get('embeds', [])
+    discord = _get_discord_api()
+    data['embeds'] = embeds[:_DISCORD_MAX_EMBEDS]
+    discord.edit_interaction_response(token, data)
+    for i in range(_DISCORD_MAX_EMBEDS, len(embeds), _DISCORD_MAX_EMBEDS):
+        discord.send_followup_message(token, {'embeds': embeds[i:i + _DISCORD_MAX_EMBEDS]})
+
+
+def discord_cmd(cmd, details_timeout=_DETAILS_TIMEOUT, channel=None):
+    """Dispatch the discord slash commands, channel is the (guild id, channel id) they were sent in."""
     opts = {}
     if 'options' in cmd:
         opts = {opt['name']: opt['value'] for opt in cmd['options']}
     if cmd['name'] == 'trophygames':
-        return discord_cmd_trophygames(opts)
+        return discord_cmd_trophygames(opts, details_timeout, channel)
+    elif cmd['name'] == 'flashpoint':
+        return discord_cmd_flashpoint(opts)
     elif cmd['name'] == 'jollymania':
-        return discord_cmd_jollymania(opts)
+        # older shortcut for the games2jolly collection
+        return discord_cmd_flashpoint({'collection': 'games2jolly'})
     elif cmd['name'] == 'random':
         return discord_cmd_random(opts)
     return abort(400, 'unknown command')
@@ -230,7 +456,10 @@ def discord_cmd(cmd):
 
 def discord_cmd_random(opts):
     """Process the discord /random command."""
-    number_range = int(opts.get('range', 0))
+    try:
+        number_range = int(opts.get('range', 0))
+    except ValueError:
+        return abort(400, 'invalid range')
     choices = opts.get('choice')
     if number_range:
         num = random.randint(1, number_range)
@@ -249,24 +478,30 @@ def discord_cmd_random(opts):
             return make_discord_response("Coinflip is: Tails / Opponent's choice")
 
 
-def discord_cmd_jollymania(opts):
-    """Process the discord /jollymania command."""
-    api = _get_jolly_api()
+def discord_cmd_flashpoint(opts):
+    """Process the discord /flashpoint command."""
+    apis = _get_flashpoint_apis()
+    name = opts.get('collection') or next(iter(apis), None)
+    api = apis.get(name)
+    if not api:
+        return make_discord_response(f'Unknown collection {markdown_format_code(str(name))}')
     try:
         game = api.get_random_game()
-        embeds = make_jolly_embeds(api, game, _JOLLY_EMBED_COLOR)
+        embeds = make_flashpoint_embeds(api, game, _FLASHPOINT_EMBED_COLOR)
         return make_discord_response('', embeds=embeds)
     except Exception as ex:
         return make_discord_response(f'Pull failed {_CONCERNED_EMOTE}: {ex}')
 
 
 
-def discord_cmd_trophygames(opts):
+def discord_cmd_trophygames(opts, details_timeout=_DETAILS_TIMEOUT, channel=None):
     """Process the discord /trophygames command."""
     game_count = int(opts.get('count', 1))
     allow_empty = bool(opts.get('empty', False))
     allow_hacks = bool(opts.get('hacks', False))
     filter_systems = opts.get('systems')
+    weighting = opts.get('weighting', 'uniform')
+    no_repeat = int(opts.get('norepeat', _DEFAULT_NO_REPEAT)) if channel else 0
     ra = _get_ra_api()
     try:
         sysmatches = []
@@ -280,13 +515,19 @@ def discord_cmd_trophygames(opts):
                     return make_discord_response(f'No match for system "{s}"')
                 sysmatches.append((s, m))
 
-        embeds = make_discord_embeds(ra, game_count,
-                                     allow_empty=allow_empty, allow_hacks=allow_hacks,
-                                     systems=[m['ID'] for (_, m) in sysmatches])
+        exclude = _PULL_HISTORY.recent(*channel, no_repeat) if no_repeat else ()
+        games = ra.get_random_games(game_count, allow_empty=allow_empty, allow_hacks=allow_hacks,
+                                    systems=[m['ID'] for (_, m) in sysmatches],
+                                    weighting=weighting, exclude=exclude)
+        if channel:
+            _PULL_HISTORY.add(*channel, [g.id for g in games])
+        embeds = make_discord_embeds(ra, games, details_timeout=details_timeout)
         text = f'Pulled {len(embeds)} random game'
         if len(embeds) > 1:
             text += 's'
         text += f' (empty: {_BOOL_EMOTE[allow_empty]}, hacks: {_BOOL_EMOTE[allow_hacks]})'
+        if weighting != 'uniform':
+            text += f'\nWeighted by: {weighting}'
         if sysmatches:
             text += '\nSystem(s): ' + ', '.join([f"{s} = {m['Name']}" for s, m in sysmatches])
 
@@ -305,41 +546,34 @@ def make_discord_response(text, embeds=None):
     return response
 
 
-def make_discord_embeds(ra: ra_api.RetroAchievementsApi, game_count: int, allow_empty: bool, allow_hacks: bool, systems: list) -> dict:
+def make_discord_embeds(ra: ra_api.RetroAchievementsApi, games: list, details_timeout=_DETAILS_TIMEOUT) -> dict:
     embeds = []
-    games = ra.get_random_games(game_count, allow_empty=allow_empty,
-                                allow_hacks=allow_hacks, systems=systems)
-    retried = False
-    for i, game in enumerate(games):
-        details = ra.get_game_details(game['ID'], ignore_error=True)
-        if not details and not retried:
-            # RA starts rate-limiting after a few requests,
-            # wait once to let it cool down
-            time.sleep(1)
-            retried = True
-            details = ra.get_game_details(game['ID'], ignore_error=True)
-        color = _DISCORD_EMBED_COLORS[i % len(_DISCORD_EMBED_COLORS)]
-        embed = make_game_embed(ra, game, details, color)
-        embeds.append(embed)
+    all_details = ra.get_many_game_details([g.id for g in games], timeout=details_timeout)
+    with metrics.timer('embed_build_seconds', source='ra'):
+        for i, game in enumerate(games):
+            details = all_details.get(game.id)
+            color = _DISCORD_EMBED_COLORS[i % len(_DISCORD_EMBED_COLORS)]
+            embed = make_game_embed(ra, game, details, color)
+            embeds.append(embed)
     return embeds
 
 
-def make_game_embed(ra: ra_api.RetroAchievementsApi, game: dict, details: dict, color: int) -> dict:
-    desc = f"**System:** {game['ConsoleName']}\n"
+def make_game_embed(ra: ra_api.RetroAchievementsApi, game: game_catalog.Game, details: dict, color: int) -> dict:
+    desc = f"**System:** {game.console_name}\n"
     if details:
         for k in ['Developer', 'Publisher', 'Genre', 'Released']:
             desc += f"**{k}:** {details[k]}\n"
-    desc += f"**Achievements:** {game['NumAchievements']}"
+    desc += f"**Achievements:** {game.num_achievements}"
 
     embed = {
         'type': 'rich',
-        'title': game['Title'],
+        'title': game.title,
         'description': desc,
         'color': color,
         'thumbnail': {
-            'url': ra.make_full_url(game['ImageIcon'])
+            'url': ra.make_full_url(game.image_icon)
         },
-        'url': ra.make_game_url(game['ID'])
+        'url': ra.make_game_url(game.id)
     }
 
     if details:
@@ -350,7 +584,8 @@ def make_game_embed(ra: ra_api.RetroAchievementsApi, game: dict, details: dict,
     return embed
 
 
-def make_jolly_embeds(api: flashpoint_db_api.FlashpointDbApi, game: dict, color: int) -> dict:
+@metrics.timed('embed_build_seconds', source='flashpoint')
+def make_flashpoint_embeds(api: flashpoint_db_api.FlashpointDbApi, game: dict, color: int) -> dict:
     embed = [{
         'type': 'rich',
         'title': game['title'],
@@ -384,4 +619,6 @@ def markdown_format_code(text):
 
 
 if __name__ == '__main__':
+    # load the game lists before accepting requests
+    load_apis()
     run(host='localhost', port=8080, debug=True)